@@ -16,7 +16,7 @@ class PocketBookToolsPlugin(InterfaceActionBase):
     supported_platforms = ['windows', 'osx', 'linux']
     author              = 'William Ouwehand'
     version             = (0, 10, 0)
-    minimum_calibre_version = (2, 58, 0)
+    minimum_calibre_version = (5, 0, 0)
 
     actual_plugin = 'calibre_plugins.pocketbook_tools.ui:PocketBookToolsPlugin'
 
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Benchmarks the books.db operations of main.py against generated databases (see gendb.py).
+
+Each operation runs in a fresh interpreter, reporting wall-time, rows/s and peak RSS.
+Results are saved as JSON, and two result files can be compared using --compare."""
+import os, sys, json, time, shutil, sqlite3, platform, datetime, subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import gendb
+
+try:
+    import resource
+except ImportError:  # windows
+    resource = None
+
+
+def _count(db, query):
+    con = sqlite3.connect(db)
+    try:
+        return con.execute(query).fetchone()[0]
+    finally:
+        con.close()
+
+
+def _op_stats(main, db, workdir):
+    return main.DbPool().stats(db)['annotations']
+
+
+def _op_export(fmt, **kwargs):
+    def op(main, db, workdir):
+        return main.export_highlights(db, os.path.join(workdir, 'export.' + fmt), fmt=fmt, **kwargs)
+    return op
+
+
+def _op_backup(main, db, workdir):
+    main.dbbackup('bench', db, workdir, labeltime=False)
+    return _count(db, 'SELECT COUNT(*) FROM Tags')
+
+
+def _op_mergefix(dryrun, **kwargs):
+    def op(main, db, workdir):
+        plan, changedrows = main.mergefix_annotations(db, dryrun=dryrun, **kwargs)
+        return _count(db, 'SELECT COUNT(*) FROM Items')
+    return op
+
+
+# name: (function(main, db, workdir) returning the number of rows processed, whether it modifies the db)
+OPERATIONS = {
+    'stats': (_op_stats, False),
+    'export-html': (_op_export('html'), False),
+    'export-csv': (_op_export('csv'), False),
+    'export-jsonl': (_op_export('jsonl'), False),
+    'export-md': (_op_export('md'), False),
+    'export-html-python': (_op_export('html', json1=False), False),
+    'export-html-sorttitle': (_op_export('html', sortontitle=True), False),
+    'export-html-workingcopy': (_op_export('html', usecopy=True), False),
+    'backup': (_op_backup, False),
+    'mergefix-dryrun': (_op_mergefix(True), False),
+    'mergefix': (_op_mergefix(False), True),
+    'mergefix-workingcopy': (_op_mergefix(False, usecopy=True), True),
+}
+
+
+def _maxrss_kb():
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss // 1024 if sys.platform == 'darwin' else maxrss  # bytes on macOS
+
+
+def run_op(name, db, workdir):
+    """Runs a single operation in this process. Returns a result dict."""
+    import main
+    function, modifies = OPERATIONS[name]
+    if modifies:
+        dbcopy = os.path.join(workdir, 'books.db')
+        shutil.copyfile(db, dbcopy)
+        db = dbcopy
+    baserss = _maxrss_kb()
+    start = time.perf_counter()
+    rows = function(main, db, workdir)
+    seconds = time.perf_counter() - start
+    return {'rows': rows, 'seconds': seconds, 'base_rss_kb': baserss, 'peak_rss_kb': _maxrss_kb()}
+
+
+def bench(name, db, workdir, repeat=3):
+    """Runs an operation repeat times, each in a fresh interpreter and work directory. Keeps the fastest run."""
+    runs = []
+    for nr in range(repeat):
+        rundir = os.path.join(workdir, 'run-%s-%d' % (name, nr))
+        shutil.rmtree(rundir, ignore_errors=True)
+        os.makedirs(rundir)
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-op', name, db, rundir],
+                             check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        runs.append(json.loads(out.splitlines()[-1]))
+        shutil.rmtree(rundir, ignore_errors=True)
+    best = min(runs, key=lambda run: run['seconds'])
+    peaks = [run['peak_rss_kb'] for run in runs if run['peak_rss_kb'] is not None]
+    return {'op': name, 'rows': best['rows'], 'seconds': best['seconds'],
+            'seconds_all': [run['seconds'] for run in runs],
+            'rows_per_s': best['rows'] / best['seconds'] if best['seconds'] else None,
+            'base_rss_kb': best['base_rss_kb'], 'peak_rss_kb': max(peaks) if peaks else None}
+
+
+def run(workdir, scales, operations, repeat=3, label=None, regenerate=False, seed=0):
+    results = []
+    for highlights in scales:
+        devroot = os.path.join(workdir, 'device-%d-%d' % (highlights, seed))
+        db = os.path.join(devroot, 'system', 'config', 'books.db')
+        if regenerate or not os.path.exists(db):
+            start = time.perf_counter()
+            gendb.build_device(devroot, highlights, seed=seed)
+            print('Generated %d highlights in %.1fs' % (highlights, time.perf_counter() - start))
+        dbsize = os.path.getsize(db)
+        for name in operations:
+            result = bench(name, db, workdir, repeat)
+            result.update({'highlights': highlights, 'dbsize': dbsize})
+            results.append(result)
+            print('%-24s %8d  %8.3fs  %10.0f rows/s  %8s KB peak RSS' % (
+                name, highlights, result['seconds'], result['rows_per_s'] or 0, result['peak_rss_kb']))
+    return {'label': label, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(), 'seed': seed, 'repeat': repeat, 'results': results}
+
+
+def compare(oldpath, newpath):
+    """Returns a text table of wall-time and peak RSS ratios (new / old) per operation and scale."""
+    with open(oldpath) as fin:
+        old = {(r['op'], r['highlights']): r for r in json.load(fin)['results']}
+    with open(newpath) as fin:
+        new = json.load(fin)['results']
+    lines = ['%-24s %8s  %8s  %8s  %6s  %6s' % ('op', 'scale', 'old s', 'new s', 'time', 'rss')]
+    for r in new:
+        o = old.get((r['op'], r['highlights']))
+        if not o:
+            continue
+        rss = '%.2f' % (r['peak_rss_kb'] / o['peak_rss_kb']) if r['peak_rss_kb'] and o['peak_rss_kb'] else '-'
+        lines.append('%-24s %8d  %8.3f  %8.3f  %6.2f  %6s' % (r['op'], r['highlights'], o['seconds'], r['seconds'],
+                                                             r['seconds'] / o['seconds'], rss))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    if len(sys.argv) == 5 and sys.argv[1] == '--run-op':
+        print(json.dumps(run_op(*sys.argv[2:])))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description='Benchmarks books.db operations on generated databases')
+    parser.add_argument('-d', '--workdir', default='pbt-bench', help='Directory for generated databases')
+    parser.add_argument('-n', '--scales', type=int, nargs='*', default=[1000, 10000, 100000],
+                        help='Highlights per generated books.db (1k to 1M)')
+    parser.add_argument('-O', '--operations', nargs='*', default=list(OPERATIONS), choices=list(OPERATIONS),
+                        metavar='OP', help='Operations to run: %s' % ', '.join(OPERATIONS))
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs per operation, the fastest is kept')
+    parser.add_argument('-l', '--label', help='Label stored with the results, e.g. a version')
+    parser.add_argument('-o', '--output', help='Save results as JSON')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    parser.add_argument('--regenerate', action='store_true', help='Regenerate existing databases')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two JSON result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        print(compare(*args.compare))
+        sys.exit(0)
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = run(args.workdir, args.scales, args.operations, args.repeat, args.label, args.regenerate, args.seed)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=1)
+        print('Saved results to %s' % args.output)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""Micro-benchmarks PbFileref for large zip listings: memory held by the file objects, and the time to create
+them, set their destination root (as _uploader_setdest), rename them (as dialog edits) and read dest_full.
+
+With --baseline, the same is measured for the PbFileref of another main.py, e.g. of an older version:
+    git show v1.0:main.py > /tmp/main_old.py
+    python benchmark/bench_fileref.py --baseline /tmp/main_old.py"""
+import os, sys, json, time, zipfile, platform, datetime, tracemalloc, importlib.util
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _loadmain(path):
+    spec = importlib.util.spec_from_file_location('pbt_main_%d' % abs(hash(path)), path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _zipinfos(entries):
+    extensions = ('.ttf', '.otf', '.acsm', '.dic')
+    return [zipfile.ZipInfo('fonts/family%04d/face%05d%s' % (nr // 20, nr, extensions[nr % len(extensions)]))
+            for nr in range(entries)]
+
+
+def _best(function, repeat):
+    best = None
+    for nr in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def measure(main, entries=10000, repeat=5):
+    """Returns a result dict for the PbFileref class of the main module."""
+    PbFileref = main.PbFileref
+    archive = '/tmp/fontpack.zip'
+    zipinfos = _zipinfos(entries)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    fileobjs = [PbFileref(archive, archive_parent=archive, zipinfo=zipinfo) for zipinfo in zipinfos]
+    for fileobj in fileobjs:
+        fileobj.setroot('/media/pocketbook')
+        fileobj.dest_full
+    memory = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    def create():
+        [PbFileref(archive, archive_parent=archive, zipinfo=zipinfo) for zipinfo in zipinfos]
+
+    def setroot():
+        for fileobj in fileobjs:
+            fileobj.setroot('/media/pocketbook')
+            fileobj.dest_full
+
+    def rename():
+        for fileobj in fileobjs:
+            fileobj.dest_filename = 'renamed-' + fileobj.filename
+            fileobj.dest_full
+
+    def state():
+        for fileobj in fileobjs:
+            fileobj.setstate(True, None)
+            fileobj.delete = False
+
+    seconds = dict((name, _best(function, repeat))
+                   for name, function in (('create', create), ('setroot', setroot), ('rename', rename),
+                                          ('state', state)))
+    return {'module': main.__file__, 'entries': entries, 'bytes': memory, 'bytes_per_entry': memory / entries,
+            'seconds': seconds}
+
+
+def _line(label, result, scale):
+    return '%-10s %10.1f KB %8.0f B/entry  %s' % (
+        label, result['bytes'] * scale / 1024, result['bytes_per_entry'],
+        '  '.join('%s %7.2f ms' % (name, seconds * scale * 1000) for name, seconds in result['seconds'].items()))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks PbFileref memory and attribute handling')
+    parser.add_argument('-n', '--entries', type=int, default=10000, help='Number of zip entries')
+    parser.add_argument('-r', '--repeat', type=int, default=5, help='Runs per timing, the fastest is kept')
+    parser.add_argument('-b', '--baseline', help='main.py to compare with')
+    parser.add_argument('-o', '--output', help='Save results as JSON')
+    args = parser.parse_args()
+
+    import main
+    results = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'current': measure(main, args.entries, args.repeat)}
+    if args.baseline:
+        results['baseline'] = measure(_loadmain(os.path.abspath(args.baseline)), args.entries, args.repeat)
+
+    scale = 10000 / args.entries
+    print('Per 10k entries:')
+    for label in ('baseline', 'current'):
+        if label in results:
+            print(_line(label, results[label], scale))
+    if args.baseline:
+        old, new = results['baseline'], results['current']
+        print('%-10s %10.1f KB %8.0f B/entry  %s' % (
+            'saved', (old['bytes'] - new['bytes']) * scale / 1024, old['bytes_per_entry'] - new['bytes_per_entry'],
+            '  '.join('%s %7.2f ms' % (name, (old['seconds'][name] - new['seconds'][name]) * scale * 1000)
+                      for name in new['seconds'])))
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=1)
+        print('Saved results to %s' % args.output)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""Benchmarks uploader_prep/uploader_copy against a fake device root (see fakedevice.py).
+
+Reports files/s and MB/s for prep, copy, verify (read-back), identical file detection and source deletion.
+With --throttle or --usb2, device writes are limited to simulate a USB mass-storage link."""
+import os, sys, json, time, shutil, platform, datetime, threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main
+import fakedevice
+
+USB2_WRITE_MBPS = 20  # typical sustained USB 2.0 mass-storage write speed of e-readers
+
+
+class Throttle:
+    """uploader_copy progress callback limiting the combined write rate of all copy threads,
+    like a single USB link shared by main memory and SD-card."""
+    def __init__(self, mbps):
+        self.rate = mbps * 1e6
+        self.lock = threading.Lock()
+        self.next = time.perf_counter()
+
+    def __call__(self, fileobj, nbytes):
+        with self.lock:
+            now = time.perf_counter()
+            self.next = max(self.next, now) + nbytes / self.rate
+            delay = self.next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _phase(name, seconds, fileobjs, size=None, **extra):
+    count = len(fileobjs)
+    size = sum(f.getsize() for f in fileobjs) if size is None else size
+    result = {'phase': name, 'files': count, 'bytes': size, 'seconds': seconds,
+              'files_per_s': count / seconds if seconds else None,
+              'mb_per_s': size / 1e6 / seconds if seconds else None}
+    result.update(extra)
+    print('%-22s %6d files %9.1f MB %8.3fs %9.1f files/s %8.1f MB/s' % (
+        name, count, size / 1e6, seconds, result['files_per_s'] or 0, result['mb_per_s'] or 0))
+    return result
+
+
+def _prep(paths, device, **kwargs):
+    mainpath, cardpath = device
+    return main.uploader_prep(paths, mainpath, cardpath, zipenabled=True, gui=True, **kwargs)
+
+
+def run_once(workdir, paths, workers=1, throttle=None):
+    """Runs all phases once on a fresh device. Returns a list of phase results."""
+    devdir = os.path.join(workdir, 'device')
+    shutil.rmtree(devdir, ignore_errors=True)
+    device = fakedevice.build_device(os.path.join(devdir, 'main'), os.path.join(devdir, 'card'))
+    results = []
+
+    start = time.perf_counter()
+    fileobjs = _prep(paths, device)
+    results.append(_phase('prep', time.perf_counter() - start, fileobjs))
+
+    jobs = [f for f in fileobjs if f.process]
+    start = time.perf_counter()
+    main.uploader_copy(fileobjs, gui=True, verify=False, workers=workers, progress=throttle)
+    results.append(_phase('copy', time.perf_counter() - start, jobs, workers=workers,
+                          throttle_mbps=throttle.rate / 1e6 if throttle else None))
+
+    copied = [f for f in jobs if f.tocopy]
+    start = time.perf_counter()
+    for fileobj in copied:
+        main.hashfile(fileobj.dest_full)  # the read-back done by _verifycopy
+    results.append(_phase('verify', time.perf_counter() - start, copied))
+
+    index = main.DeviceIndex(os.path.join(devdir, 'index.json'))
+    for name, index in (('identical-filecmp', None), ('identical-index-cold', index), ('identical-index-warm', index)):
+        start = time.perf_counter()
+        fileobjs = _prep(paths, device, index=index)
+        seconds = time.perf_counter() - start
+        results.append(_phase(name, seconds, fileobjs,
+                              identical=sum(1 for f in fileobjs if f.msg == 'Skipped, identical file exists')))
+
+    # deleting sources, as uploader_copy does after copying, on a copy of the corpus
+    deletedir = os.path.join(workdir, 'delete')
+    shutil.rmtree(deletedir, ignore_errors=True)
+    os.makedirs(deletedir)
+    deletepaths = [shutil.copy(path, deletedir) for path in paths]
+    shutil.rmtree(devdir, ignore_errors=True)
+    device = fakedevice.build_device(os.path.join(devdir, 'main'), os.path.join(devdir, 'card'))
+    fileobjs = _prep(deletepaths, device, deletemode=3)
+    deleted = [f for f in fileobjs if f.delete]
+    size = sum(f.getsize() for f in deleted)
+    todelete = sorted(set(main._deletesource(f) for f in deleted))
+    start = time.perf_counter()
+    for path in todelete:
+        os.remove(path)
+    results.append(_phase('delete', time.perf_counter() - start, deleted, size, deletedfiles=len(todelete)))
+    shutil.rmtree(deletedir, ignore_errors=True)
+    return results
+
+
+def run(workdir, files=100, zips=4, zipmembers=20, scale=1.0, workers=1, throttle=None, repeat=1, label=None,
+        seed=0):
+    corpusdir = os.path.join(workdir, 'corpus-%d-%d-%d-%g-%d' % (files, zips, zipmembers, scale, seed))
+    if os.path.exists(corpusdir):
+        paths = sorted(os.path.join(corpusdir, name) for name in os.listdir(corpusdir))
+    else:
+        paths, total = fakedevice.build_corpus(corpusdir, files, zips, zipmembers, scale, seed)
+    best = {}
+    for nr in range(repeat):
+        for result in run_once(workdir, paths, workers, Throttle(throttle) if throttle else None):
+            if result['phase'] not in best or result['seconds'] < best[result['phase']]['seconds']:
+                best[result['phase']] = result
+    return {'label': label, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'corpus': {'files': files, 'zips': zips, 'zipmembers': zipmembers, 'scale': scale, 'seed': seed},
+            'workers': workers, 'throttle_mbps': throttle, 'repeat': repeat, 'results': list(best.values())}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmarks uploading to a fake PocketBook device root')
+    parser.add_argument('-d', '--workdir', default='pbt-bench-upload', help='Directory for corpus and device')
+    parser.add_argument('-n', '--files', type=int, default=100, help='Number of loose files')
+    parser.add_argument('-z', '--zips', type=int, default=4, help='Number of zip archives')
+    parser.add_argument('--zipmembers', type=int, default=20, help='Files per zip archive')
+    parser.add_argument('--scale', type=float, default=0.1, help='File size multiplier')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Concurrent copies per destination root')
+    parser.add_argument('-t', '--throttle', type=float, help='Limit device writes to this many MB/s')
+    parser.add_argument('--usb2', dest='throttle', action='store_const', const=USB2_WRITE_MBPS,
+                        help='Limit device writes to %d MB/s, simulating USB 2.0' % USB2_WRITE_MBPS)
+    parser.add_argument('-r', '--repeat', type=int, default=1, help='Runs, the fastest is kept per phase')
+    parser.add_argument('-l', '--label', help='Label stored with the results, e.g. a version')
+    parser.add_argument('-o', '--output', help='Save results as JSON')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = run(args.workdir, args.files, args.zips, args.zipmembers, args.scale, args.workers, args.throttle,
+                  args.repeat, args.label, args.seed)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(results, out, indent=1)
+        print('Saved results to %s' % args.output)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Builds a local fake PocketBook device root (and optional SD card root), and a corpus of uploadable
+files and zips, for exercising uploader_prep/uploader_copy without a mounted reader.
+
+Output is deterministic for a given seed, so results can be compared between versions."""
+import os, random, zipfile, sqlite3
+
+import gendb
+
+DEVICE_DIRS = ('system/fonts', 'system/dictionaries', 'system/config', 'applications')
+
+# extension: (share of files, min size, max size) in bytes
+CORPUS_TYPES = {
+    '.acsm': (0.40, 2 * 1024, 8 * 1024),
+    '.ttf': (0.25, 30 * 1024, 4 * 1024 * 1024),
+    '.otf': (0.10, 30 * 1024, 2 * 1024 * 1024),
+    '.dic': (0.10, 512 * 1024, 40 * 1024 * 1024),
+    '.app': (0.10, 64 * 1024, 8 * 1024 * 1024),
+    '.pbi': (0.05, 1024 * 1024, 60 * 1024 * 1024),
+}
+
+POOLSIZE = 1024 * 1024
+
+
+def build_device(mainpath, cardpath=None, profiles=('default',)):
+    """Creates the device directories, an explorer-3.db listing the profiles and their config directories.
+    Creates cardpath if provided. Returns (mainpath, cardpath)."""
+    for reldir in DEVICE_DIRS:
+        os.makedirs(os.path.join(mainpath, reldir), exist_ok=True)
+    for name in profiles:
+        os.makedirs(os.path.join(mainpath, 'system', 'profiles', name, 'config'), exist_ok=True)
+    explorerdir = os.path.join(mainpath, 'system', 'explorer-3')
+    os.makedirs(explorerdir, exist_ok=True)
+    explorerdb = os.path.join(explorerdir, 'explorer-3.db')
+    if not os.path.exists(explorerdb):
+        con = sqlite3.connect(explorerdb)
+        con.execute(gendb.EXPLORER_SCHEMA)
+        con.executemany('INSERT INTO profiles (name) VALUES (?)', [(name,) for name in profiles])
+        con.commit()
+        con.close()
+    if cardpath:
+        os.makedirs(cardpath, exist_ok=True)
+    return mainpath, cardpath
+
+
+class _Content:
+    """Incompressible, deterministic file content: a random pool read at a per-file offset,
+    prefixed by the file name so every file has a distinct digest."""
+    def __init__(self, rnd):
+        self.pool = rnd.getrandbits(POOLSIZE * 8).to_bytes(POOLSIZE, 'little')
+
+    def write(self, fout, name, size, offset):
+        data = name.encode('utf-8')[:size]
+        fout.write(data)
+        remaining = size - len(data)
+        while remaining > 0:
+            block = self.pool[offset:offset + remaining]
+            fout.write(block)
+            remaining -= len(block)
+            offset = 0
+
+
+def _pickfiles(rnd, count, scale):
+    extensions = list(CORPUS_TYPES)
+    weights = [CORPUS_TYPES[ext][0] for ext in extensions]
+    for nr in range(count):
+        ext = rnd.choices(extensions, weights)[0]
+        share, minsize, maxsize = CORPUS_TYPES[ext]
+        size = max(1, int(rnd.uniform(minsize, maxsize) * scale))
+        yield 'file%05d%s' % (nr, ext), size, rnd.randrange(POOLSIZE)
+
+
+def build_corpus(corpusdir, files=100, zips=0, zipmembers=20, scale=1.0, seed=0):
+    """Creates 'files' loose files and 'zips' zip archives of 'zipmembers' files (stored and deflated)
+    in corpusdir. File sizes are drawn per type from CORPUS_TYPES and multiplied by scale.
+    Returns the list of created paths and their total (uncompressed) size."""
+    rnd = random.Random(seed)
+    content = _Content(rnd)
+    os.makedirs(corpusdir, exist_ok=True)
+    paths = []
+    total = 0
+    for name, size, offset in _pickfiles(rnd, files, scale):
+        path = os.path.join(corpusdir, name)
+        with open(path, 'wb') as fout:
+            content.write(fout, name, size, offset)
+        paths.append(path)
+        total += size
+    for zipnr in range(zips):
+        path = os.path.join(corpusdir, 'archive%03d.zip' % zipnr)
+        compression = zipfile.ZIP_DEFLATED if zipnr % 2 else zipfile.ZIP_STORED
+        with zipfile.ZipFile(path, 'w', compression) as zipf:
+            zipf.writestr(zipfile.ZipInfo('docs/'), b'')  # directory entry
+            for name, size, offset in _pickfiles(rnd, zipmembers, scale):
+                name = 'z%03d-%s' % (zipnr, name)
+                with zipf.open(name, 'w', force_zip64=size > 2 ** 31) as fout:
+                    content.write(fout, name, size, offset)
+                total += size
+            zipf.writestr('docs/readme.txt', b'Unsupported member, skipped by the uploader')
+        paths.append(path)
+    return paths, total
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Builds a fake PocketBook device root and an upload corpus')
+    parser.add_argument('-m', '--mainpath', required=True, help='Device root to create')
+    parser.add_argument('-c', '--cardpath', help='SD card root to create')
+    parser.add_argument('-p', '--profiles', nargs='*', default=['default'], help='Profile names')
+    parser.add_argument('-d', '--corpus', help='Directory for the upload corpus')
+    parser.add_argument('-n', '--files', type=int, default=100, help='Number of loose files')
+    parser.add_argument('-z', '--zips', type=int, default=0, help='Number of zip archives')
+    parser.add_argument('--zipmembers', type=int, default=20, help='Files per zip archive')
+    parser.add_argument('--scale', type=float, default=1.0, help='File size multiplier')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    build_device(args.mainpath, args.cardpath, args.profiles)
+    if args.corpus:
+        paths, total = build_corpus(args.corpus, args.files, args.zips, args.zipmembers, args.scale, args.seed)
+        print('Created %d files (%.1f MB) in %s' % (len(paths), total / 1e6, args.corpus))
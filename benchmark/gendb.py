@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+"""Generates PocketBook shaped databases for benchmarking: an explorer-3.db with a profiles table,
+and books.db files with Books/Items/Tags rows as written by the reader (highlights with page
+locations, notes, bookmarks, deleted items and duplicate titles).
+
+Output is deterministic for a given seed, so results can be compared between versions."""
+import os, json, random, sqlite3
+
+BATCHSIZE = 10000
+
+BOOKSDB_SCHEMA = '''
+    CREATE TABLE Books (OID INTEGER PRIMARY KEY, Title TEXT, Authors TEXT, Series TEXT, Numinseries INTEGER,
+                        Size INTEGER, isbn TEXT, sort_title TEXT, updated INTEGER, ts_added INTEGER);
+    CREATE TABLE Items (OID INTEGER PRIMARY KEY, ParentID INTEGER, TypeID INTEGER, State INTEGER,
+                        TimeAlt INTEGER, HashUUID TEXT);
+    CREATE TABLE Tags (OID INTEGER PRIMARY KEY, ItemID INTEGER, TagID INTEGER, Val TEXT, TimeEdt INTEGER);
+    CREATE TABLE TagNames (OID INTEGER PRIMARY KEY, TagName TEXT);
+    CREATE INDEX ITEMS_PARENTID_INDEX ON Items(ParentID);
+    CREATE INDEX TAGS_ITEMID_INDEX ON Tags(ItemID);
+    '''
+
+TAGNAMES = ((101, 'bm.anchor'), (102, 'bm.type'), (103, 'bm.color'), (104, 'bm.quotation'), (105, 'bm.note'))
+COLORS = ('yellow', 'red', 'green', 'blue', 'gray')
+WORDS = ('the', 'of', 'and', 'reader', 'ink', 'page', 'chapter', 'river', 'night', 'letter', 'quiet', 'journey',
+         'Ünïcödé', 'naïve', '“quoted”', '<tag>', 'a & b', 'line\nbreak', '€', 'tab\there')
+
+EXPLORER_SCHEMA = 'CREATE TABLE profiles (id INTEGER PRIMARY KEY, name TEXT)'
+
+
+def _text(rnd, words):
+    return ' '.join(rnd.choice(WORDS) for _ in range(words))
+
+
+def _dumps(val):
+    return json.dumps(val, separators=(',', ':'), ensure_ascii=False)
+
+
+def _batched(rows, con, query):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCHSIZE:
+            con.executemany(query, batch)
+            batch = []
+    if batch:
+        con.executemany(query, batch)
+
+
+def build_booksdb(path, highlights=1000, books=None, dupratio=0.1, bookmarkratio=0.1, noteratio=0.05,
+                  deletedratio=0.02, editedratio=0.01, seed=0):
+    """Creates a books.db at path (replacing an existing one) with the given number of highlight items.
+    Books default to one per 20 highlights; dupratio of them repeat an earlier Title/Authors under a newer OID.
+    bookmarkratio adds bookmarks on top of the highlights. Returns a dict of the generated counts."""
+    rnd = random.Random(seed)
+    books = books or max(10, highlights // 20)
+    bookmarks = int(highlights * bookmarkratio)
+    if os.path.exists(path):
+        os.remove(path)
+
+    con = sqlite3.connect(path)
+    con.executescript(BOOKSDB_SCHEMA)
+    con.executemany('INSERT INTO TagNames VALUES (?, ?)', TAGNAMES)
+
+    titles = []
+    dupes = 0
+    for oid in range(1, books + 1):
+        if titles and rnd.random() < dupratio:
+            title, authors = rnd.choice(titles)
+            dupes += 1
+        else:
+            title, authors = 'Title %d %s' % (oid, _text(rnd, 3)), 'Author %d' % rnd.randrange(books // 3 + 1)
+            titles.append((title, authors))
+        row = (oid, title, authors, None, None, rnd.randrange(10 ** 5, 10 ** 7), None, title.lower(),
+               1600000000 + oid, 1600000000 + oid)
+        con.execute('INSERT INTO Books VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', row)
+
+    counts = {'books': books, 'titledupes': dupes, 'highlights': 0, 'notes': 0, 'bookmarks': 0, 'deleted': 0,
+              'edited': 0}
+
+    def items():
+        for oid in range(1, highlights + bookmarks + 1):
+            state = 1 if rnd.random() < deletedratio else 0
+            counts['deleted'] += state
+            yield oid, rnd.randrange(1, books + 1), 4, state, 1600000000 + oid, '%032x' % rnd.getrandbits(128)
+
+    def tags():
+        for itemid in range(1, highlights + bookmarks + 1):
+            edt = 1600000000 + itemid
+            if itemid > highlights:
+                counts['bookmarks'] += 1
+                yield itemid, 101, 'pbr:/word?page=%d&offs=0' % rnd.randrange(500), edt
+                yield itemid, 102, 'bookmark', edt
+                yield itemid, 104, _dumps({'text': 'Bookmark'}), edt
+                continue
+            page, offs = rnd.randrange(500), rnd.randrange(5000)
+            isnote = rnd.random() < noteratio
+            counts['notes' if isnote else 'highlights'] += 1
+            yield itemid, 102, 'note' if isnote else 'highlight', edt
+            yield itemid, 103, rnd.choice(COLORS), edt
+            if rnd.random() < editedratio:  # edited using the Notes app: location is lost
+                counts['edited'] += 1
+                val = {'text': _text(rnd, rnd.randrange(3, 40))}
+            else:
+                val = {'begin': 'pbr:/word?page=%d&offs=%d#0' % (page, offs),
+                       'end': 'pbr:/word?page=%d&offs=%d#0' % (page, offs + 200),
+                       'text': _text(rnd, rnd.randrange(3, 40))}
+            yield itemid, 104, _dumps(val), edt
+            if isnote:
+                yield itemid, 105, _text(rnd, rnd.randrange(2, 20)), edt
+
+    _batched(items(), con, 'INSERT INTO Items VALUES (?, ?, ?, ?, ?, ?)')
+    _batched(tags(), con, 'INSERT INTO Tags (ItemID, TagID, Val, TimeEdt) VALUES (?, ?, ?, ?)')
+    con.commit()
+    con.close()
+    return counts
+
+
+def build_device(root, highlights=1000, profiles=('default',), seed=0, **kwargs):
+    """Creates a device root with system/explorer-3/explorer-3.db listing the profiles, a books.db in
+    system/config and one per profile in system/profiles/<name>/config. Returns a list of (path, counts)."""
+    explorerdir = os.path.join(root, 'system', 'explorer-3')
+    os.makedirs(explorerdir, exist_ok=True)
+    explorerdb = os.path.join(explorerdir, 'explorer-3.db')
+    if os.path.exists(explorerdb):
+        os.remove(explorerdb)
+    con = sqlite3.connect(explorerdb)
+    con.execute(EXPLORER_SCHEMA)
+    con.executemany('INSERT INTO profiles (name) VALUES (?)', [(name,) for name in profiles])
+    con.commit()
+    con.close()
+
+    out = []
+    configdirs = [os.path.join(root, 'system', 'config')]
+    configdirs += [os.path.join(root, 'system', 'profiles', name, 'config') for name in profiles]
+    for nr, configdir in enumerate(configdirs):
+        os.makedirs(configdir, exist_ok=True)
+        path = os.path.join(configdir, 'books.db')
+        out.append((path, build_booksdb(path, highlights, seed=seed + nr, **kwargs)))
+    return out
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generates a fake PocketBook device root with books.db files')
+    parser.add_argument('root', help='Device root to create')
+    parser.add_argument('-n', '--highlights', type=int, default=1000, help='Highlights per books.db')
+    parser.add_argument('-p', '--profiles', nargs='*', default=['default'], help='Profile names')
+    parser.add_argument('-b', '--books', type=int, help='Books per books.db (default: highlights / 20)')
+    parser.add_argument('--dupratio', type=float, default=0.1, help='Fraction of duplicate title entries')
+    parser.add_argument('--bookmarkratio', type=float, default=0.1, help='Bookmarks per highlight')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for path, counts in build_device(args.root, args.highlights, args.profiles, seed=args.seed, books=args.books,
+                                     dupratio=args.dupratio, bookmarkratio=args.bookmarkratio):
+        print('%s: %s' % (path, ', '.join('%s %d' % item for item in counts.items())))
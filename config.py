@@ -1,13 +1,14 @@
 from calibre.utils.config import JSONConfig
 from calibre.constants import numeric_version as calibre_version
+from calibre_plugins.pocketbook_tools.main import HIGHLIGHT_FORMATS
 
 try:
     from PyQt5.Qt import (Qt, QCheckBox, QGridLayout, QGroupBox, QIcon,
-                          QHBoxLayout, QVBoxLayout, QWidget, pyqtSignal, QLabel, QComboBox)
+                          QHBoxLayout, QVBoxLayout, QWidget, pyqtSignal, QLabel, QComboBox, QSpinBox)
 except ImportError as e:
     print('Problem loading QT5: ', e)
     from PyQt4.Qt import (Qt, QCheckBox, QGridLayout, QGroupBox, QIcon,
-                          QHBoxLayout, QVBoxLayout, QWidget, pyqtSignal, QLabel, QComboBox)
+                          QHBoxLayout, QVBoxLayout, QWidget, pyqtSignal, QLabel, QComboBox, QSpinBox)
 
 import logging
 logger = logging.getLogger('pbt_logger.config')
@@ -20,8 +21,20 @@ prefs.defaults['up_zipenabled'] = True
 prefs.defaults['up_acsmtocard'] = False
 prefs.defaults['up_alwaysreplace'] = True
 prefs.defaults['up_deletemode'] = 0
+prefs.defaults['up_trustcopy'] = False
+prefs.defaults['up_workers'] = 1
 prefs.defaults['bk_include_emptybookdb'] = False
+prefs.defaults['bk_pagesperstep'] = 256
+prefs.defaults['bk_mode'] = 0
+prefs.defaults['bk_keepsnapshots'] = 0
+prefs.defaults['bk_skipunchanged'] = True
+prefs.defaults['bk_fingerprinthash'] = False
 prefs.defaults['hl_sortdate'] = 0
+prefs.defaults['hl_format'] = 'html'
+prefs.defaults['hl_incremental'] = False
+prefs.defaults['hl_allprofiles'] = False
+prefs.defaults['gn_workingcopy'] = False
+prefs.defaults['gn_mirror'] = False
 prefs.defaults['debug'] = False
 
 
@@ -56,6 +69,21 @@ class ConfigWidget(QWidget):
         self.up_acsmtocard.setChecked(prefs['up_acsmtocard'])
         self.cfg_runtime_options_qup.addWidget(self.up_acsmtocard)
 
+        self.up_trustcopy = QCheckBox(_('Skip verifying copied files (faster)'))
+        self.up_trustcopy.setToolTip(_('Copied files are not read back from the device to compare checksums.'))
+        self.up_trustcopy.setChecked(prefs['up_trustcopy'])
+        self.cfg_runtime_options_qup.addWidget(self.up_trustcopy)
+
+        self.up_workers_hbox = QHBoxLayout()
+        self.cfg_runtime_options_qup.addLayout(self.up_workers_hbox)
+        self.up_workers_label = QLabel('Simultaneous copies per destination:')
+        self.up_workers_hbox.addWidget(self.up_workers_label)
+        self.up_workers_spinBox = QSpinBox(self.cfg_runtime_options_gb)
+        self.up_workers_spinBox.setRange(1, 8)
+        self.up_workers_spinBox.setToolTip(_('Main memory and SD-card are always written simultaneously.'))
+        self.up_workers_spinBox.setValue(prefs['up_workers'])
+        self.up_workers_hbox.addWidget(self.up_workers_spinBox)
+
         self.up_deletemode_hbox = QHBoxLayout()
         self.up_deletemode_hbox.setObjectName('Delete options Hbox')
         self.cfg_runtime_options_qup.addLayout(self.up_deletemode_hbox)
@@ -83,6 +111,32 @@ class ConfigWidget(QWidget):
         self.bk_include_emptybookdb.setChecked(prefs['bk_include_emptybookdb'])
         self.cfg_runtime_options_qbk.addWidget(self.bk_include_emptybookdb)
 
+        self.bk_skipunchanged = QCheckBox(_('Skip databases unchanged since their last backup'))
+        self.bk_skipunchanged.setToolTip(_('Compares size, modification time and the database change counter.'))
+        self.bk_skipunchanged.setChecked(prefs['bk_skipunchanged'])
+        self.cfg_runtime_options_qbk.addWidget(self.bk_skipunchanged)
+
+        self.bk_mode_hbox = QHBoxLayout()
+        self.cfg_runtime_options_qbk.addLayout(self.bk_mode_hbox)
+        self.bk_mode_label = QLabel('Backup format:')
+        self.bk_mode_hbox.addWidget(self.bk_mode_label)
+        self.bk_mode_comboBox = QComboBox(self.cfg_runtime_options_gb)
+        self.bk_mode_comboBox.addItem('Dated copies')
+        self.bk_mode_comboBox.addItem('Incremental backup store')
+        self.bk_mode_comboBox.setToolTip(_('A backup store only saves changed parts of databases. '
+                                           'Snapshots can be listed and restored using the main.py CLI.'))
+        self.bk_mode_comboBox.setCurrentIndex(prefs['bk_mode'])
+        self.bk_mode_hbox.addWidget(self.bk_mode_comboBox)
+
+        self.bk_keepsnapshots_hbox = QHBoxLayout()
+        self.cfg_runtime_options_qbk.addLayout(self.bk_keepsnapshots_hbox)
+        self.bk_keepsnapshots_label = QLabel('Snapshots to keep in backup store (0 = all):')
+        self.bk_keepsnapshots_hbox.addWidget(self.bk_keepsnapshots_label)
+        self.bk_keepsnapshots_spinBox = QSpinBox(self.cfg_runtime_options_gb)
+        self.bk_keepsnapshots_spinBox.setRange(0, 999)
+        self.bk_keepsnapshots_spinBox.setValue(prefs['bk_keepsnapshots'])
+        self.bk_keepsnapshots_hbox.addWidget(self.bk_keepsnapshots_spinBox)
+
         # export options
         self.cfg_runtime_options_gb = QGroupBox(_('Export options'))
         self.cfg_runtime_options_gb.setObjectName('Export options')
@@ -105,12 +159,44 @@ class ConfigWidget(QWidget):
         self.hl_sortdate_comboBox.setCurrentIndex(prefs['hl_sortdate'])
         self.hl_sortdate_hbox.addWidget(self.hl_sortdate_comboBox)
 
+        self.hl_format_hbox = QHBoxLayout()
+        self.cfg_runtime_options_qex.addLayout(self.hl_format_hbox)
+        self.hl_format_label = QLabel('Export highlights as:')
+        self.hl_format_hbox.addWidget(self.hl_format_label)
+        self.hl_format_comboBox = QComboBox(self.cfg_runtime_options_gb)
+        for fmt, (label, extensions, formatter) in sorted(HIGHLIGHT_FORMATS.items()):
+            self.hl_format_comboBox.addItem(label, fmt)
+        self.hl_format_comboBox.setCurrentIndex(max(0, self.hl_format_comboBox.findData(prefs['hl_format'])))
+        self.hl_format_hbox.addWidget(self.hl_format_comboBox)
+
+        self.hl_incremental = QCheckBox(_('Only append new highlights to existing export files'))
+        self.hl_incremental.setToolTip(_('Export files are rebuilt when modified, or when sorting by title and page.'))
+        self.hl_incremental.setChecked(prefs['hl_incremental'])
+        self.cfg_runtime_options_qex.addWidget(self.hl_incremental)
+
+        self.hl_allprofiles = QCheckBox(_('Export all profiles to a single file'))
+        self.hl_allprofiles.setToolTip(_('Adds a Profile column. Exports are rebuilt, instead of appended to.'))
+        self.hl_allprofiles.setChecked(prefs['hl_allprofiles'])
+        self.cfg_runtime_options_qex.addWidget(self.hl_allprofiles)
+
         # Other options
         self.cfg_runtime_options_gb = QGroupBox(_('Other options'))
         self.cfg_runtime_options_gb.setObjectName('Other options')
         self.l.addWidget(self.cfg_runtime_options_gb)
         self.cfg_runtime_options_gn = QVBoxLayout(self.cfg_runtime_options_gb)
 
+        self.gn_workingcopy = QCheckBox(_('Query a local copy of books.db for exports and merge/fix'))
+        self.gn_workingcopy.setToolTip(_('Copies books.db to a temporary file with extra indexes, '
+                                         'which can be faster than querying the device directly.'))
+        self.gn_workingcopy.setChecked(prefs['gn_workingcopy'])
+        self.cfg_runtime_options_gn.addWidget(self.gn_workingcopy)
+
+        self.gn_mirror = QCheckBox(_('Keep a local copy of annotations, synced on connect'))
+        self.gn_mirror.setToolTip(_('Highlights are exported from the local copy, which also works '
+                                    'while the reader is disconnected.'))
+        self.gn_mirror.setChecked(prefs['gn_mirror'])
+        self.cfg_runtime_options_gn.addWidget(self.gn_mirror)
+
         self.gn_debug = QCheckBox(_('Enable debug logging to console (no restart required)'))
         self.gn_debug.setToolTip(_('Log debug messages to console.'))
         self.gn_debug.setChecked(prefs['debug'])
@@ -122,7 +208,17 @@ class ConfigWidget(QWidget):
         prefs['up_acsmtocard'] = self.up_acsmtocard.isChecked()
         prefs['up_alwaysreplace'] = self.up_alwaysreplace.isChecked()
         prefs['up_deletemode'] = self.up_deletemode_comboBox.currentIndex()
+        prefs['up_trustcopy'] = self.up_trustcopy.isChecked()
+        prefs['up_workers'] = self.up_workers_spinBox.value()
         prefs['bk_include_emptybookdb'] = self.bk_include_emptybookdb.isChecked()
+        prefs['bk_skipunchanged'] = self.bk_skipunchanged.isChecked()
+        prefs['bk_mode'] = self.bk_mode_comboBox.currentIndex()
+        prefs['bk_keepsnapshots'] = self.bk_keepsnapshots_spinBox.value()
         prefs['hl_sortdate'] = self.hl_sortdate_comboBox.currentIndex()
+        prefs['hl_format'] = self.hl_format_comboBox.currentData()
+        prefs['hl_incremental'] = self.hl_incremental.isChecked()
+        prefs['hl_allprofiles'] = self.hl_allprofiles.isChecked()
+        prefs['gn_workingcopy'] = self.gn_workingcopy.isChecked()
+        prefs['gn_mirror'] = self.gn_mirror.isChecked()
         prefs['debug'] = self.gn_debug.isChecked()
         logger.debug(prefs)
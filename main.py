@@ -1,8 +1,24 @@
-import os, shutil, filecmp, sqlite3, json, zipfile
+import os, shutil, filecmp, sqlite3, json, zipfile, hashlib, zlib, struct
+import csv, html, io, collections, contextlib, tempfile, re
 import time, datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import pathname2url
 import logging
 logger = logging.getLogger('pbt_logger.main')
 
+COPY_BLOCKSIZE = 1024 * 1024  # bytes per read/write while streaming files to the device
+HASH_ALGO = 'sha1'  # copy verification digest
+DBBACKUP_PAGES = 256  # pages copied per sqlite online backup step
+BACKUPSTORE_CHUNKPAGES = 16  # sqlite pages per backup store chunk
+EXPORT_BATCHSIZE = 1000  # rows per fetchmany while exporting highlights
+EXPORT_BUFFERSIZE = 256 * 1024  # export file write buffer
+SEARCH_LIMIT = 20  # default number of highlight search results
+PROFILEDBS_ATTACHED = 10  # databases attached per connection, sqlite's default limit
+QUERYTRACE_RECORDS = 1000  # queries kept by querytrace, the oldest are dropped
+
+_ziplock = threading.Lock()
+
 
 def getexplorerdb(root):
     """Returns location of explorer-x.db, where x is 3 or 2."""
@@ -15,11 +31,140 @@ def getexplorerdb(root):
     return
 
 
+class QueryTrace:
+    """Optional instrumentation of the queries issued by this module. When enabled, records the
+    EXPLAIN QUERY PLAN and wall-time of each query, and logs them at debug level. Keeps the last
+    QUERYTRACE_RECORDS queries since the last reset."""
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Discards the recorded queries, e.g. when starting a new run."""
+        with self.lock:
+            self.records = collections.deque(maxlen=QUERYTRACE_RECORDS)
+
+    def _record(self, con, query, params, seconds, rows=None):
+        try:
+            plan = [row[-1] for row in con.execute('EXPLAIN QUERY PLAN ' + query, params)]
+        except sqlite3.Error as e:
+            plan = ['(no plan: %s)' % e]
+        record = {'query': ' '.join(query.split()), 'plan': plan, 'seconds': seconds, 'rows': rows}
+        with self.lock:
+            self.records.append(record)
+        logger.debug('%.3fs %s\n    %s' % (seconds, record['query'], '\n    '.join(plan)))
+
+    def execute(self, con, query, params=()):
+        """Wraps con.execute. Timing covers the execute call, i.e. full statements and the first result row."""
+        if not self.enabled:
+            return con.execute(query, params)
+        start = time.time()
+        cursor = con.execute(query, params)
+        self._record(con, query, params, time.time() - start)
+        return cursor
+
+    def rows(self, con, query, params=(), batchsize=EXPORT_BATCHSIZE):
+        """Yields all result rows, fetched in batches. Timing covers fetching every row."""
+        start = time.time()
+        count = 0
+        cursor = con.execute(query, params)
+        try:
+            while True:
+                rows = cursor.fetchmany(batchsize)
+                if not rows:
+                    break
+                count += len(rows)
+                for row in rows:
+                    yield row
+        finally:
+            if self.enabled:
+                self._record(con, query, params, time.time() - start, count)
+
+    def report(self):
+        """Returns a text report of the recorded queries."""
+        return '\n\n'.join('%.3fs %s rows: %s\n    %s' % (r['seconds'], '-' if r['rows'] is None else r['rows'],
+                                                         r['query'], '\n    '.join(r['plan']))
+                           for r in self.records)
+
+
+querytrace = QueryTrace()
+
+
+class RunSummary:
+    """Timings of the phases of a run (discovery, prep, copy, export...), as spans aggregated per name
+    with item and byte counters. Spans may be recorded from several threads."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, run=None):
+        """Starts a new run, discarding recorded spans."""
+        with self.lock:
+            self.run = run
+            self.started = time.time()
+            self.spans = collections.OrderedDict()
+
+    def add(self, name, seconds, items=0, nbytes=0):
+        with self.lock:
+            span = self.spans.setdefault(name, {'count': 0, 'seconds': 0.0, 'items': 0, 'bytes': 0})
+            span['count'] += 1
+            span['seconds'] += seconds
+            span['items'] += items
+            span['bytes'] += nbytes
+
+    @contextlib.contextmanager
+    def span(self, name, items=0, nbytes=0):
+        """Times the with-block as span name. Yields a dict, whose 'items' and 'bytes' counters may be updated."""
+        counters = {'items': items, 'bytes': nbytes}
+        start = time.perf_counter()
+        try:
+            yield counters
+        finally:
+            self.add(name, time.perf_counter() - start, counters['items'], counters['bytes'])
+
+    def timed(self, name, iterable):
+        """Yields from iterable, recording the time spent producing the items as span name."""
+        seconds = 0.0
+        items = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    seconds += time.perf_counter() - start
+                items += 1
+                yield item
+        finally:
+            self.add(name, seconds, items)
+
+    def summary(self):
+        """Returns the run summary as a JSON serializable dict."""
+        with self.lock:
+            return {'run': self.run,
+                    'started': datetime.datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                    'seconds': time.time() - self.started,
+                    'spans': dict((name, dict(span)) for name, span in self.spans.items())}
+
+    def emit(self):
+        """Logs the run summary as JSON at debug level, and returns it."""
+        summary = self.summary()
+        logger.debug('Run summary: %s' % json.dumps(summary))
+        return summary
+
+
+runsummary = RunSummary()
+
+
 def sqlite_execute_query(db, query):
     """Returns results for a (simple) sqlite query to provided db path."""
     out = []
     con = sqlite3.connect(db)
-    for row in con.execute(query):
+    for row in querytrace.execute(con, query):
         out += row
     con.close()
     logger.debug(out)
@@ -44,27 +189,89 @@ def getprofilepaths(profilenames, mainpath, cardpath=None):
     return [(profile, profpath) for (profile, profpath) in profilepaths if os.path.exists(profpath)]
 
 
+def discover_device(mainpath, cardpath=None, explorerdbpath=None):
+    """Returns the explorer db path, existing (profile, config path) and (profile, books.db path) lists
+    for a mounted device. Returns (None, [], []) if no explorer db is found."""
+    with runsummary.span('discovery') as counters:
+        explorerdbpath = explorerdbpath or getexplorerdb(mainpath)
+        if not explorerdbpath:
+            return None, [], []
+        profiles = sqlite_execute_query(explorerdbpath, query="SELECT name from profiles")  # tested v37
+        profilepaths = getprofilepaths(profiles, mainpath, cardpath)
+        # alt: search for books.db. However, if count > 1 complexity becomes similar.
+        bookdbs = [(profile, os.path.join(path, 'books.db')) for profile, path in profilepaths]
+        counters['items'] = len(bookdbs)
+    return explorerdbpath, profilepaths, bookdbs
+
+
+class DiscoveryCache:
+    """Host-side cache of discover_device results, keyed by device identity and paths.
+    An entry is valid while the explorer db mtime is unchanged, so reconnecting the same device
+    only costs locating and stat-ing the explorer db."""
+    FILENAME = 'discovery.json'
+
+    def __init__(self, statedir=None):
+        self.path = os.path.join(statedir or hoststatedir(), self.FILENAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as fin:
+                    self.entries = json.load(fin)
+            except ValueError:
+                logger.exception('Ignoring corrupt discovery cache: %s' % self.path)
+
+    def discover(self, deviceid, mainpath, cardpath=None):
+        """Returns discover_device results, from cache if the explorer db did not change."""
+        explorerdbpath = getexplorerdb(mainpath)
+        if not explorerdbpath:
+            return None, [], []
+        key = '%s|%s|%s' % (deviceid, mainpath, cardpath)
+        mtime = os.path.getmtime(explorerdbpath)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['explorerdbpath'] == explorerdbpath and entry['mtime'] == mtime:
+                logger.debug('Using cached discovery for %s' % key)
+                return explorerdbpath, [tuple(x) for x in entry['profilepaths']], [tuple(x) for x in entry['bookdbs']]
+
+        explorerdbpath, profilepaths, bookdbs = discover_device(mainpath, cardpath, explorerdbpath=explorerdbpath)
+        with self.lock:
+            self.entries[key] = {'explorerdbpath': explorerdbpath, 'mtime': mtime,
+                                 'profilepaths': profilepaths, 'bookdbs': bookdbs}
+            _writejson(self.path, self.entries)
+        return explorerdbpath, profilepaths, bookdbs
+
+
 def _checkfile(srcpath=None):
     """Basic check (for CLI) consisting of file existing and size > 0. Returns true/false"""
     return srcpath and os.path.exists(srcpath) and os.stat(srcpath).st_size > 0
 
 
+# supported file extension: (filetype label, relative destination directory on device)
+FORMAT_EXTENSIONS = {
+    '.ttf': ('FONT', 'system/fonts/'),
+    '.otf': ('FONT', 'system/fonts/'),
+    '.dic': ('DICT', 'system/dictionaries/'),
+    '.pbi': ('INSTALLER', ''),
+    '.app': ('APP', 'applications/'),
+    '.acsm': ('ACSM', ''),
+}
+
+
 def _pb_filedest(path):
     """ Simple file extension identifier, returns filetype label and (relative) destination directory on device. """
-    FORMAT_EXTENSIONS = {
-        '.ttf': ('FONT', 'system/fonts/'),
-        '.otf': ('FONT', 'system/fonts/'),
-        '.dic': ('DICT', 'system/dictionaries/'),
-        '.pbi': ('INSTALLER', ''),
-        '.app': ('APP', 'applications/'),
-        '.acsm': ('ACSM', ''),
-    }
     filetype, destpath = FORMAT_EXTENSIONS.get(os.path.splitext(path)[1], (None, None))
     return filetype, os.path.normpath(destpath) if destpath else destpath
 
 
 class PbFileref:
-    """WIP file object class. Contains source, destination and filetype details."""
+    """WIP file object class. Contains source, destination and filetype details.
+    Uses __slots__, as zip listings can create thousands. dest_full is computed on first access after
+    setroot or a dest_filename change."""
+    __slots__ = ('srcpath', 'archive_parent', 'zipinfo', 'path', 'filename', 'filetype', 'dest_rel', 'dest_root',
+                 '_dest_filename', '_dest_full', 'tocard', 'delete', 'digest', 'process', 'msg', 'tocopy',
+                 'msg_outcome', 'wasdeleted')
+
     def __init__(self, path, archive_parent=None, zipinfo=None):
         self.srcpath = path
         self.archive_parent = archive_parent
@@ -73,31 +280,35 @@ class PbFileref:
         self.tocard = False
         self.setfilemeta()
         self.delete = None
-
-    def __setattr__(self, name, value):
-        if name == 'dest_filename':
-            self.__dict__['dest_filename'] = value
-            self._set_dest_full()
-
-        self.__dict__[name] = value
+        self.digest = None
+        self.process = self.msg = self.tocopy = self.msg_outcome = None
+        self.wasdeleted = False
 
     def setfilemeta(self):
         self.path, self.filename = os.path.split(self.srcpath) if not self.zipinfo else os.path.split(self.zipinfo.filename)
         self.filetype, self.dest_rel = _pb_filedest(self.filename)
-        # self.dest_full = None
         self.dest_root = None
         self.dest_filename = self.filename
 
+    @property
+    def dest_filename(self):
+        return self._dest_filename
+
+    @dest_filename.setter
+    def dest_filename(self, value):
+        self._dest_filename = value
+        self._dest_full = None
+
+    @property
+    def dest_full(self):
+        if self._dest_full is None and self.dest_root is not None and self.dest_rel is not None:
+            self._dest_full = os.path.join(self.dest_root, self.dest_rel, self._dest_filename)
+        return self._dest_full
+
     def setroot(self, dest_root, tocard=False):
         self.tocard = tocard
         self.dest_root = dest_root
-        self._set_dest_full()
-
-    def _set_dest_full(self):
-        if self.dest_root is not None and self.dest_rel is not None:
-            self.dest_full = os.path.join(self.dest_root, self.dest_rel, self.dest_filename)
-        else:
-            self.dest_full = None
+        self._dest_full = None
 
     def setstate(self, process, msg):
         self.process = process
@@ -113,13 +324,24 @@ class PbFileref:
         if wasdeleted:
             self.msg_outcome += ' (deleted source)'
 
-    def do_copyfile(self):
-        if self.zipinfo:
-            copied = copyzipfile(self.archive_parent, self.zipinfo, self.dest_full)
-        else:
-            copied = copymovefile(self.srcpath, self.dest_full)
+    def do_copyfile(self, zipf=None, verify=True, progress=None):
+        # verified after closing the copy span, so the read-back is only counted in its own 'verify' span
+        with runsummary.span('copy', items=1) as counters:
+            if self.zipinfo:
+                copied = copyzipfile(self.archive_parent, self.zipinfo, self.dest_full, zipf=zipf, verify=False,
+                                     progress=progress)
+            else:
+                copied = copymovefile(self.srcpath, self.dest_full, verify=False, progress=progress)
+            if copied:
+                counters['bytes'] = self.getsize()
+        if copied:
+            copied = _verifycopy(self.dest_full, copied, verify)
+        self.digest = copied
         return copied
 
+    def getsize(self):
+        return self.zipinfo.file_size if self.zipinfo else os.path.getsize(self.srcpath)
+
     def __call__(self):
         return self.srcpath, self.dest_full
 
@@ -130,21 +352,87 @@ class PbFileref:
         return '%s to %s' % (self.srcpath, self.dest_full)
 
 
-def copyfile(srcpath, destpath):
-    """Copy file using shutil.copy. Returns True on success."""
+def hashfile(path):
+    """Returns the HASH_ALGO hexdigest of a file, reading it once in blocks."""
+    h = hashlib.new(HASH_ALGO)
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(COPY_BLOCKSIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class CopyCancelled(Exception):
+    """Raised by a progress callback to abort a copy. The partial (*.tmp) file is removed."""
+
+
+def _copystream(fin, destpath, progress=None):
+    """Writes file object fin to destpath in blocks, hashing the data while writing. Returns the hexdigest.
+    Optional progress(nbytes) is called after each block written, and may raise CopyCancelled."""
+    h = hashlib.new(HASH_ALGO)
+    with open(destpath, 'wb') as fout:
+        for block in iter(lambda: fin.read(COPY_BLOCKSIZE), b''):
+            h.update(block)
+            fout.write(block)
+            if progress:
+                progress(len(block))
+        fout.flush()
+        os.fsync(fout.fileno())
+    return h.hexdigest()
+
+
+def _verifycopy(destpath, digest, verify=True):
+    """Single read-back of destpath, compared to the digest taken while copying. Returns digest or None.
+    In trust mode (verify=False) the read-back is skipped."""
+    if not verify:
+        return digest
+    with runsummary.span('verify', items=1) as counters:
+        try:
+            verified = hashfile(destpath) == digest
+            counters['bytes'] = os.path.getsize(destpath)
+        except OSError:
+            logger.exception('Verification failed: %s' % destpath)
+            return
+    if not verified:
+        logger.error('Verification failed, digest mismatch: %s' % destpath)
+        return
+    return digest
+
+
+def _removetmp(dest_tmp):
+    if os.path.exists(dest_tmp):
+        os.remove(dest_tmp)
+
+
+def copyfile(srcpath, destpath, verify=True, progress=None):
+    """Copies a file, hashing the source while writing and verifying by hashing the destination.
+    Copies permission bits like shutil.copy. Returns the digest on success."""
     try:
-        shutil.copy(srcpath, destpath)
+        with open(srcpath, 'rb') as fin:
+            digest = _copystream(fin, destpath, progress)
+        shutil.copymode(srcpath, destpath)
+    except CopyCancelled:
+        _removetmp(destpath)
+        raise
     except:
         logger.exception('Copy failed: %s - %s' % (srcpath, destpath))
         return
-        # catch shutil.SameFileError? --> 2nd exception, cannot be handled.
     else:
-        return filecmp.cmp(srcpath, destpath, shallow=False)
+        return _verifycopy(destpath, digest, verify)
+
 
-def copymovefile(srcpath, destpath):
-    """Wrapper for copyfile. Performs copies using an interim *.tmp file."""
+def copymovefile(srcpath, destpath, verify=True, progress=None):
+    """Copies a file using an interim *.tmp file, verifying after the move. Returns the digest on success."""
     dest_tmp = destpath + '.tmp'
-    if not copyfile(srcpath, dest_tmp):
+    try:
+        with open(srcpath, 'rb') as fin:
+            digest = _copystream(fin, dest_tmp, progress)
+        shutil.copymode(srcpath, dest_tmp)
+    except CopyCancelled:
+        _removetmp(dest_tmp)
+        raise
+    except:
+        logger.exception('Copy failed: %s - %s' % (srcpath, dest_tmp))
+        _removetmp(dest_tmp)
         return
 
     try:
@@ -153,50 +441,646 @@ def copymovefile(srcpath, destpath):
         logger.exception('Move failed: %s - %s' % (dest_tmp, destpath))
         return
     else:
-        return filecmp.cmp(srcpath, destpath, shallow=False)
+        return _verifycopy(destpath, digest, verify)
 
 
-def copyzipfile(archive_parent, zipinfo, destpath):
-    """Extracts a zipfile's bytes directly to a file, forgoing extraction.
-    Loses metadata. Mind ram usage with large files (alt: loop block copy in py3.x)"""
+def copyzipfile(archive_parent, zipinfo, destpath, zipf=None, verify=True, progress=None):
+    """Streams a zip member to destpath using an interim *.tmp file, forgoing extraction.
+    Memory use is bounded by COPY_BLOCKSIZE. Reuses zipf (an open ZipFile) if provided.
+    Loses metadata, except for mod/access time on linux/mac. Returns the digest on success."""
+    dest_tmp = destpath + '.tmp'
+    try:
+        if zipf is None:
+            with zipfile.ZipFile(archive_parent, 'r') as zipf:
+                digest = _copyzipmember(zipf, zipinfo, dest_tmp, progress)
+        else:
+            digest = _copyzipmember(zipf, zipinfo, dest_tmp, progress)
+        # fix mod/access time for linux/mac
+        datetime_epoch = time.mktime(zipinfo.date_time + (0, 0, -1))
+        os.utime(dest_tmp, times=(datetime_epoch, datetime_epoch))
+    except CopyCancelled:
+        _removetmp(dest_tmp)
+        raise
+    except:
+        logger.exception('Zip extract failed: %s - %s - %s' % (archive_parent, zipinfo, destpath))
+        _removetmp(dest_tmp)
+        return
 
-    with zipfile.ZipFile(archive_parent, 'r') as zipf:
-        filecontent = zipf.read(zipinfo)
+    try:
+        shutil.move(dest_tmp, destpath)
+    except:
+        logger.exception('Move failed: %s - %s' % (dest_tmp, destpath))
+        return
+    else:
+        return _verifycopy(destpath, digest, verify)
 
-    if filecontent:
-        try:
-            with open(destpath, 'wb') as fout:
-                fout.write(filecontent)
-        except:
-            logger.exception('Zip extract failed: %s - %s - %s' % (archive_parent, zipinfo, destpath))
-        else:
-            # fix mod/access time for linux/mac
-            datetime_epoch = time.mktime(zipinfo.date_time + (0, 0, -1))
-            os.utime(destpath, times=(datetime_epoch, datetime_epoch))
-            return True
 
-    return
+def _copyzipmember(zipf, zipinfo, destpath, progress=None):
+    """Block copies a zip member to destpath. ZipFile.open checks the CRC when reaching EOF.
+    A shared ZipFile may be read by several threads; opening and closing members is serialized."""
+    with _ziplock:
+        fin = zipf.open(zipinfo, 'r')
+    try:
+        return _copystream(fin, destpath, progress)
+    finally:
+        with _ziplock:
+            fin.close()
 
 
-def dbbackup(profile, bookdbpath, exportdir, labeltime=True):
-    """Copies db files labeled with profile and datetime."""
+def hoststatedir():
+    """Returns the host-side directory for plugin state (indexes, caches), creating it if needed.
+    Uses calibre's config_dir when available (plugin), otherwise the user's home directory (CLI)."""
+    try:
+        from calibre.utils.config import config_dir
+        statedir = os.path.join(config_dir, 'plugins', 'pocketbook_tools')
+    except ImportError:
+        statedir = os.path.join(os.path.expanduser('~'), '.pocketbook_tools')
+    if not os.path.isdir(statedir):
+        os.makedirs(statedir)
+    return statedir
+
+
+def devicekey(explorerdbpath):
+    """Returns a short filename-safe key identifying a device, based on its explorer db location."""
+    path = os.path.normcase(os.path.abspath(explorerdbpath))
+    return hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+
+
+def _writejson(path, data):
+    """Writes data as json using an interim *.tmp file, so a crash does not leave a partial file."""
+    with open(path + '.tmp', 'w') as fout:
+        json.dump(data, fout)
+    os.replace(path + '.tmp', path)
+
+
+class DeviceIndex:
+    """Host-side index of files on a device, mapping device paths to [size, mtime, digest, crc].
+    Entries are only trusted while size and mtime of the device file are unchanged, so identical
+    file checks cost a stat instead of reading back the device file."""
+    def __init__(self, indexpath):
+        self.indexpath = indexpath
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(indexpath):
+            try:
+                with open(indexpath, 'r') as fin:
+                    self.entries = json.load(fin)
+            except ValueError:
+                logger.exception('Ignoring corrupt device index: %s' % indexpath)
+
+    @classmethod
+    def for_device(cls, explorerdbpath, statedir=None):
+        statedir = statedir or hoststatedir()
+        return cls(os.path.join(statedir, 'deviceindex-%s.json' % devicekey(explorerdbpath)))
+
+    def lookup(self, path):
+        """Returns the entry for path if still valid, else None."""
+        key = os.path.normpath(path)
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st and entry[0] == st.st_size and entry[1] == st.st_mtime:
+            return entry
+        del self.entries[key]
+        self.changed = True
+
+    def update(self, path, digest, crc=None):
+        """Records a verified device file. Call after copying, so mtime reflects the final file."""
+        st = os.stat(path)
+        self.entries[os.path.normpath(path)] = [st.st_size, st.st_mtime, digest, crc]
+        self.changed = True
+
+    def scan(self, path):
+        """Reads a device file once to (re)index it. Returns the entry."""
+        digest, crc = _hashcrcfile(path)
+        self.update(path, digest, crc)
+        return self.entries[os.path.normpath(path)]
+
+    def identical(self, fileobj):
+        """Checks if fileobj's destination holds the same content as its source.
+        Zip members compare sizes and CRC's when available, other files compare digests."""
+        entry = self.lookup(fileobj.dest_full) or self.scan(fileobj.dest_full)
+        size, mtime, digest, crc = entry
+        if size != fileobj.getsize():
+            return False
+        if fileobj.zipinfo and crc is not None:
+            return crc == fileobj.zipinfo.CRC
+        return digest == _srcdigest(fileobj)
+
+    def save(self):
+        if self.changed:
+            _writejson(self.indexpath, self.entries)
+            self.changed = False
+
+
+class UploadJournal:
+    """Host-side, append-only journal of a device's uploads, so an interrupted run (unplugged reader, crash)
+    can be resumed. Records each planned copy by destination, with its source and source signature, then its
+    completed copy with digest, size and mtime, and deleted sources. A copy counts as completed while the
+    source signature and the destination's size and mtime are unchanged. See uploader_prep and uploader_copy."""
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}  # normalized dest path: entry dict
+        self.deleted = set()
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r') as fin:
+                for line in fin:
+                    try:
+                        self._apply(json.loads(line))
+                    except ValueError:
+                        logger.debug('Ignoring partial journal record: %s' % path)
+
+    @classmethod
+    def for_device(cls, explorerdbpath, statedir=None):
+        statedir = statedir or hoststatedir()
+        return cls(os.path.join(statedir, 'uploadjournal-%s.jsonl' % devicekey(explorerdbpath)))
+
+    def _apply(self, record):
+        op = record.pop('op')
+        if op == 'plan':
+            record['state'] = 'planned'
+            self.entries[record['dest']] = record
+        elif op == 'copied' and record['dest'] in self.entries:
+            self.entries[record['dest']].update(record, state='copied')
+        elif op == 'deleted':
+            self.deleted.add(record['source'])
+
+    def _append(self, records):
+        with self.lock:
+            with open(self.path, 'a') as fout:
+                for record in records:
+                    fout.write(json.dumps(record) + '\n')
+                    self._apply(dict(record))
+                fout.flush()
+                os.fsync(fout.fileno())
+
+    @staticmethod
+    def _source(fileobj):
+        """Returns the source and signature of a fileobj: size and CRC for zip members, else size and mtime."""
+        if fileobj.zipinfo:
+            return fileobj.archive_parent, fileobj.zipinfo.filename, [fileobj.zipinfo.file_size, fileobj.zipinfo.CRC]
+        st = os.stat(fileobj.srcpath)
+        return fileobj.srcpath, None, [st.st_size, st.st_mtime]
+
+    def completed(self, fileobj):
+        """Returns the journal entry if fileobj was copied before and its destination is unchanged, else None."""
+        entry = self.entries.get(os.path.normpath(fileobj.dest_full)) if fileobj.dest_full else None
+        if not entry or entry['state'] != 'copied':
+            return
+        try:
+            source, member, signature = self._source(fileobj)
+            st = os.stat(fileobj.dest_full)
+        except OSError:
+            return
+        if [entry['source'], entry['member'], entry['signature']] == [source, member, signature] and \
+                [entry['size'], entry['mtime']] == [st.st_size, st.st_mtime]:
+            return entry
+
+    def plan(self, fileobjs):
+        """Records the copies of fileobjs that are not completed yet."""
+        records = []
+        for fileobj in fileobjs:
+            if not self.completed(fileobj):
+                source, member, signature = self._source(fileobj)
+                records.append({'op': 'plan', 'dest': os.path.normpath(fileobj.dest_full), 'source': source,
+                                'member': member, 'signature': signature})
+        self._append(records)
+
+    def copied(self, fileobj, digest, verified=True):
+        """Records a completed copy, and whether its source is to be deleted. Call after the copy was moved
+        into place (and verified), or again when resuming a completed copy."""
+        st = os.stat(fileobj.dest_full)
+        self._append([{'op': 'copied', 'dest': os.path.normpath(fileobj.dest_full), 'digest': digest,
+                       'verified': verified, 'size': st.st_size, 'mtime': st.st_mtime,
+                       'delete': bool(fileobj.delete)}])
+
+    def sourcedeleted(self, source):
+        self._append([{'op': 'deleted', 'source': source}])
+
+    def cleantmp(self, fileobjs):
+        """Removes stale *.tmp files of interrupted copies: those of planned journal entries, and in the
+        destination folders of fileobjs, those of supported file types. Returns the removed paths."""
+        candidates = set(dest + '.tmp' for dest, entry in self.entries.items() if entry['state'] == 'planned')
+        suffixes = tuple(ext + '.tmp' for ext in FORMAT_EXTENSIONS)
+        for destdir in set(os.path.dirname(f.dest_full) for f in fileobjs if f.dest_full):
+            if os.path.isdir(destdir):
+                candidates.update(os.path.join(destdir, name) for name in os.listdir(destdir)
+                                  if name.endswith(suffixes))
+        removed = []
+        for path in sorted(candidates):
+            try:
+                if os.path.isfile(path):
+                    os.remove(path)
+                    removed.append(path)
+            except OSError:
+                logger.exception('Removing stale file failed: %s' % path)
+        if removed:
+            logger.debug('Removed stale tmp files: %s' % removed)
+        return removed
+
+    def compact(self):
+        """Rewrites the journal, keeping only completed copies whose source still awaits deletion.
+        Removes the journal if nothing is left to resume."""
+        with self.lock:
+            keep = [entry for entry in self.entries.values() if entry['state'] == 'copied' and entry['delete']
+                    and entry['source'] not in self.deleted and os.path.exists(entry['source'])]
+            self.entries = dict((entry['dest'], entry) for entry in keep)
+            self.deleted = set()
+            if not keep:
+                _removetmp(self.path)
+                return
+            with open(self.path + '.tmp', 'w') as fout:
+                for entry in keep:
+                    fout.write(json.dumps({'op': 'plan', 'dest': entry['dest'], 'source': entry['source'],
+                                           'member': entry['member'], 'signature': entry['signature']}) + '\n')
+                    fout.write(json.dumps({'op': 'copied', 'dest': entry['dest'], 'digest': entry['digest'],
+                                           'verified': entry['verified'], 'size': entry['size'],
+                                           'mtime': entry['mtime'], 'delete': entry['delete']}) + '\n')
+            os.replace(self.path + '.tmp', self.path)
+
+
+def _hashcrcfile(path):
+    """Returns the HASH_ALGO hexdigest and crc32 of a file, reading it once."""
+    h = hashlib.new(HASH_ALGO)
+    crc = 0
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(COPY_BLOCKSIZE), b''):
+            h.update(block)
+            crc = zlib.crc32(block, crc)
+    return h.hexdigest(), crc
+
+
+def _srcdigest(fileobj):
+    """Returns the HASH_ALGO hexdigest of a fileobj's source (read on the host)."""
+    if not fileobj.zipinfo:
+        return hashfile(fileobj.srcpath)
+    h = hashlib.new(HASH_ALGO)
+    with zipfile.ZipFile(fileobj.archive_parent, 'r') as zipf, zipf.open(fileobj.zipinfo, 'r') as fin:
+        for block in iter(lambda: fin.read(COPY_BLOCKSIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def sqlite_connect_ro(db):
+    """Opens a read-only connection, which never creates the database file or journals on the device."""
+    return sqlite3.connect('file:%s?mode=ro' % pathname2url(os.path.abspath(db)), uri=True)
+
+
+def _dbstats(con):
+    """Returns annotation counts and the number of duplicate titles for a books.db connection."""
+    annotations, highlights, bookmarks = querytrace.execute(con,
+        "SELECT COUNT(*), COALESCE(SUM(Val <> 'bookmark'), 0), COALESCE(SUM(Val = 'bookmark'), 0) "
+        "FROM Tags WHERE TagID = 102").fetchone()
+    titledupes = querytrace.execute(con, 'SELECT COUNT(*) FROM (SELECT OID FROM Books'
+                                         ' GROUP BY Title, Authors HAVING COUNT(*) > 1)').fetchone()[0]
+    return {'annotations': annotations, 'highlights': highlights, 'bookmarks': bookmarks, 'titledupes': titledupes}
+
+
+class DbPool:
+    """Keeps a stats snapshot per database (see _dbstats), valid while its fingerprint (see dbfingerprint) is
+    unchanged. Read-only connections are only pooled for the duration of a user action, using the pool as a
+    context manager, and closed when it ends: open handles on the reader can block ejecting it."""
+    EMPTYSTATS = {'annotations': 0, 'highlights': 0, 'bookmarks': 0, 'titledupes': 0}
+
+    def __init__(self):
+        self.connections = {}
+        self.snapshots = {}  # db: (fingerprint, stats)
+        self.depth = 0
+
+    def __enter__(self):
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if not self.depth:
+            self.release()
+
+    def get(self, db):
+        if db not in self.connections:
+            self.connections[db] = sqlite_connect_ro(db)
+        return self.connections[db]
+
+    def stats(self, db):
+        """Returns the stats snapshot for db, only scanning it if it changed since the last call."""
+        try:
+            fingerprint = dbfingerprint(db)
+            snapshot = self.snapshots.get(db)
+            if snapshot and snapshot[0] == fingerprint:
+                return snapshot[1]
+            stats = _dbstats(self.get(db))
+        except (sqlite3.Error, OSError):
+            logger.exception('Reading stats failed: %s' % db)
+            return dict(self.EMPTYSTATS)
+        finally:
+            if not self.depth:
+                self.release()
+        self.snapshots[db] = (fingerprint, stats)
+        logger.debug('%s: %s' % (db, stats))
+        return stats
+
+    def release(self):
+        """Closes the connections, keeping the stats snapshots."""
+        for con in self.connections.values():
+            con.close()
+        self.connections = {}
+
+    def close(self):
+        self.release()
+        self.snapshots = {}
+
+
+def dbbackup(profile, bookdbpath, exportdir, labeltime=True, pages=DBBACKUP_PAGES, progress=None):
+    """Backs up a (possibly in use) db using the sqlite online backup API, labeled with profile and datetime.
+    Copies 'pages' pages per step, producing a consistent snapshot in a single pass.
+    Optional progress(remaining, total) is called after each step. Returns the backup path on success."""
     logger.debug('start dbbackup')
     dbname = os.path.basename(bookdbpath)
     time = '-' + datetime.datetime.now().strftime("%Y-%b-%d_%H-%M") if labeltime else '' # avoid colons on windows (streams)
     dest = os.path.join(exportdir, dbname + '-' + profile + time + '.db')
-    return copyfile(bookdbpath, dest)
+    with runsummary.span('backup', items=1) as counters:
+        if not _sqlitebackup(bookdbpath, dest, pages=pages, progress=progress):
+            return
+        counters['bytes'] = os.path.getsize(dest)
+    return dest
 
 
-def uploader_prep(files, mainpath, cardpath=None, zipenabled=False, replace=False, deletemode=0, gui=False):
-    """Copy supported files to device main or card memory. Creates file objects for uploader. See pbfile class for supported files."""
+def _sqlitebackup(srcpath, destpath, pages=DBBACKUP_PAGES, progress=None):
+    """Snapshots srcpath to destpath using an interim *.tmp file. Returns True on success."""
+    dest_tmp = destpath + '.tmp'
+    _removetmp(dest_tmp)
+    try:
+        src = sqlite_connect_ro(srcpath)
+        try:
+            dst = sqlite3.connect(dest_tmp)
+            try:
+                src.backup(dst, pages=pages,
+                           progress=(lambda status, remaining, total: progress(remaining, total)) if progress else None)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        os.replace(dest_tmp, destpath)
+    except:
+        logger.exception('Backup failed: %s - %s' % (srcpath, destpath))
+        _removetmp(dest_tmp)
+        return
+    return True
+
+
+def dbfingerprint(path, withhash=False):
+    """Returns a fingerprint of a database: size, mtime, sqlite file change counter, and size, mtime and
+    checkpoint sequence and salts of a -wal file (a WAL reused after a checkpoint keeps its size, commits then
+    only change its mtime and, when restarted, its salts). Only reads the 100 byte header and 32 byte WAL
+    header, unless withhash adds a digest of the whole file."""
+    st = os.stat(path)
+    with open(path, 'rb') as fin:
+        header = fin.read(100)
+    fingerprint = {'size': st.st_size, 'mtime': st.st_mtime,
+                   'changecounter': struct.unpack('>I', header[24:28])[0] if len(header) >= 28 else None,
+                   'walsize': 0, 'walmtime': None, 'walheader': None}
+    wal = path + '-wal'
+    if os.path.exists(wal):
+        walst = os.stat(wal)
+        with open(wal, 'rb') as fin:
+            walheader = fin.read(32)
+        fingerprint.update(walsize=walst.st_size, walmtime=walst.st_mtime, walheader=walheader[12:24].hex())
+    if withhash:
+        fingerprint['digest'] = hashfile(path)
+    return fingerprint
+
+
+class BackupFingerprints:
+    """Fingerprints of databases at their last backup, stored in the backup directory.
+    Used to skip databases that did not change since, without reading them."""
+    FILENAME = 'pocketbook_tools-fingerprints.json'
+
+    def __init__(self, exportdir):
+        self.path = os.path.join(exportdir, self.FILENAME)
+        self.records = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as fin:
+                    self.records = json.load(fin)
+            except ValueError:
+                logger.exception('Ignoring corrupt fingerprints file: %s' % self.path)
+
+    @staticmethod
+    def _key(dbpath):
+        return os.path.normcase(os.path.abspath(dbpath))
+
+    def unchanged(self, dbpath, fingerprint):
+        """Returns a reason if dbpath is unchanged since its last (still existing) backup, else None."""
+        record = self.records.get(self._key(dbpath))
+        if not record or not os.path.exists(record['backup']):
+            return
+        last = record['fingerprint']
+        if any(last.get(key) != value for key, value in fingerprint.items()):
+            return
+        return 'unchanged since backup of %s (%s)' % (record['time'], ', '.join(sorted(fingerprint)))
+
+    def record(self, dbpath, fingerprint, backup):
+        """Records the fingerprint taken before backing up dbpath to backup (a file path)."""
+        self.records[self._key(dbpath)] = {'fingerprint': fingerprint, 'backup': backup,
+                                           'time': datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}
+
+    def save(self):
+        _writejson(self.path, self.records)
+
+
+HELPER_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS pbt_tags_tagid_itemid ON Tags(TagID, ItemID)',
+    'CREATE INDEX IF NOT EXISTS pbt_items_parentid ON Items(ParentID)',
+    'CREATE INDEX IF NOT EXISTS pbt_books_title_authors ON Books(Title, Authors)',
+)
+
+
+@contextlib.contextmanager
+def workingcopy(db, workdir=None):
+    """Yields the path of a local snapshot of db with HELPER_INDEXES added, which is removed afterwards.
+    Lets heavy queries use helper indexes, without changing the device database schema."""
+    fd, localdb = tempfile.mkstemp(prefix='pbt-', suffix='.db', dir=workdir)
+    os.close(fd)
+    try:
+        if not _sqlitebackup(db, localdb):
+            raise IOError('Creating working copy failed: %s' % db)
+        con = sqlite3.connect(localdb)
+        try:
+            for query in HELPER_INDEXES:
+                con.execute(query)
+            con.commit()
+        finally:
+            con.close()
+        logger.debug('Working copy of %s: %s' % (db, localdb))
+        yield localdb
+    finally:
+        _removetmp(localdb)
+
+
+def _sqlitepagesize(path):
+    """Returns the page size from a sqlite database header."""
+    with open(path, 'rb') as fin:
+        header = fin.read(100)
+    if len(header) < 100 or not header.startswith(b'SQLite format 3\x00'):
+        return 4096  # empty or not a database, any chunk size works
+    pagesize = struct.unpack('>H', header[16:18])[0]
+    return 65536 if pagesize == 1 else pagesize
+
+
+class BackupStore:
+    """Incremental, content-addressed backup repository for device databases.
+    Snapshots are split into chunks of BACKUPSTORE_CHUNKPAGES sqlite pages, stored zlib compressed under
+    their digest, so unchanged pages are only stored once. Each snapshot is described by a json manifest."""
+    def __init__(self, root):
+        self.root = root
+        self.chunkdir = os.path.join(root, 'chunks')
+        self.manifestdir = os.path.join(root, 'manifests')
+        for path in (self.chunkdir, self.manifestdir):
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def _chunkpath(self, digest):
+        return os.path.join(self.chunkdir, digest[:2], digest)
+
+    def _putchunk(self, digest, data):
+        """Stores a chunk unless present. Returns True if it was new."""
+        path = self._chunkpath(digest)
+        if os.path.exists(path):
+            return False
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path + '.tmp', 'wb') as fout:
+            fout.write(zlib.compress(data))
+        os.replace(path + '.tmp', path)
+        return True
+
+    def snapshot(self, profile, dbpath, pages=DBBACKUP_PAGES, progress=None):
+        """Takes a consistent snapshot of dbpath (see dbbackup) and stores its new chunks.
+        Returns the manifest dict, or None on failure."""
+        dbname = os.path.basename(dbpath)
+        snapshot_tmp = os.path.join(self.root, 'snapshot.tmp')
+        if not _sqlitebackup(dbpath, snapshot_tmp, pages=pages, progress=progress):
+            return
+
+        chunksize = _sqlitepagesize(snapshot_tmp) * BACKUPSTORE_CHUNKPAGES
+        h = hashlib.new(HASH_ALGO)
+        chunks = []
+        newchunks = 0
+        try:
+            with open(snapshot_tmp, 'rb') as fin:
+                for data in iter(lambda: fin.read(chunksize), b''):
+                    h.update(data)
+                    digest = hashlib.new(HASH_ALGO, data).hexdigest()
+                    newchunks += self._putchunk(digest, data)
+                    chunks.append(digest)
+            size = os.path.getsize(snapshot_tmp)
+        finally:
+            os.remove(snapshot_tmp)
+
+        created = datetime.datetime.now()
+        snapshotid = '%s-%s-%s' % (dbname, profile, created.strftime('%Y%m%d-%H%M%S'))
+        while os.path.exists(self._manifestpath(snapshotid)):
+            snapshotid += '_'
+        manifest = {'id': snapshotid, 'profile': profile, 'dbname': dbname, 'source': dbpath,
+                    'created': created.isoformat(), 'size': size, 'digest': h.hexdigest(),
+                    'chunksize': chunksize, 'chunks': chunks, 'newchunks': newchunks,
+                    'path': self._manifestpath(snapshotid)}
+        _writejson(self._manifestpath(snapshotid), manifest)
+        logger.debug('Stored snapshot %s, %d of %d chunks new' % (snapshotid, newchunks, len(chunks)))
+        return manifest
+
+    def _manifestpath(self, snapshotid):
+        return os.path.join(self.manifestdir, snapshotid + '.json')
+
+    def snapshots(self, profile=None, dbname=None):
+        """Returns manifests, oldest first, optionally filtered on profile and/or db name."""
+        manifests = []
+        for filename in os.listdir(self.manifestdir):
+            if not filename.endswith('.json'):
+                continue
+            with open(os.path.join(self.manifestdir, filename), 'r') as fin:
+                manifest = json.load(fin)
+            if (profile is None or manifest['profile'] == profile) and \
+                    (dbname is None or manifest['dbname'] == dbname):
+                manifests.append(manifest)
+        return sorted(manifests, key=lambda m: m['created'])
+
+    def restore(self, snapshotid, destpath):
+        """Reassembles a snapshot byte-for-byte to destpath, verifying its digest. Returns True on success."""
+        with open(self._manifestpath(snapshotid), 'r') as fin:
+            manifest = json.load(fin)
+        dest_tmp = destpath + '.tmp'
+        h = hashlib.new(HASH_ALGO)
+        try:
+            with open(dest_tmp, 'wb') as fout:
+                for digest in manifest['chunks']:
+                    with open(self._chunkpath(digest), 'rb') as fin:
+                        data = zlib.decompress(fin.read())
+                    h.update(data)
+                    fout.write(data)
+            if h.hexdigest() != manifest['digest']:
+                raise ValueError('Digest mismatch for snapshot %s' % snapshotid)
+            os.replace(dest_tmp, destpath)
+        except:
+            logger.exception('Restore failed: %s - %s' % (snapshotid, destpath))
+            _removetmp(dest_tmp)
+            return
+        return True
+
+    def prune(self, keep):
+        """Keeps the newest 'keep' snapshots per profile and db (all if keep is 0), and removes chunks no longer
+        referenced. Returns the removed snapshot ids and the number of removed chunks."""
+        manifests = self.snapshots()
+        groups = {}
+        for manifest in manifests:
+            groups.setdefault((manifest['profile'], manifest['dbname']), []).append(manifest)
+
+        removed = []
+        for group in groups.values():
+            for manifest in group[:-keep] if keep > 0 else []:
+                os.remove(self._manifestpath(manifest['id']))
+                removed.append(manifest['id'])
+
+        referenced = set()
+        for manifest in self.snapshots():
+            referenced.update(manifest['chunks'])
+        removedchunks = 0
+        for subdir in os.listdir(self.chunkdir):
+            for digest in os.listdir(os.path.join(self.chunkdir, subdir)):
+                if digest not in referenced:
+                    os.remove(os.path.join(self.chunkdir, subdir, digest))
+                    removedchunks += 1
+        return removed, removedchunks
+
+
+def uploader_prep(files, mainpath, cardpath=None, zipenabled=False, replace=False, deletemode=0, gui=False, index=None,
+                  skipped=None, journal=None):
+    """Copy supported files to device main or card memory. Creates file objects for uploader. See pbfile class for supported files.
+    If a DeviceIndex is provided, identical files are detected from the index instead of reading the device.
+    Unreadable files and unsupported zip members get no file object. They are counted per reason in the optional
+    skipped Counter instead.
+    With an UploadJournal, files completely copied by an interrupted earlier run are kept for uploader_copy,
+    which resumes them without copying (but deleting sources as planned)."""
+    skipped = collections.Counter() if skipped is None else skipped
     fileobjs = []
     for filepath in files:
-        fileobjs += _uploader_getfileobj(filepath, zipenabled=zipenabled)
+        with runsummary.span('getfileobj') as counters:
+            found = list(_uploader_getfileobj(filepath, zipenabled=zipenabled, skipped=skipped))
+            counters['items'] = len(found)
+        fileobjs += found
 
     logger.debug('File objects: %s' % fileobjs)
+    if skipped:
+        logger.debug('Skipped: %s' % dict(skipped))
 
     for f in fileobjs:
-        _uploader_setdest(f, mainpath, cardpath=cardpath, replace=replace, gui=gui)
+        with runsummary.span('setdest', items=1):
+            _uploader_setdest(f, mainpath, cardpath=cardpath, replace=replace, gui=gui, index=index, journal=journal)
 
         if f.delete == None and (
                 (deletemode >= 1 and not f.zipinfo and f.filetype == 'ACSM') or \
@@ -206,33 +1090,164 @@ def uploader_prep(files, mainpath, cardpath=None, zipenabled=False, replace=Fals
         else:
             f.delete = False
 
+    if index:
+        index.save()
+
     # do future GUI interaction here
     return fileobjs
 
-def uploader_copy(fileobjs, deletemode=0, gui=False):
-    """Copies file objects to device main or card memory. See uploader_prep"""
+def _openarchive(archives, archive_parent):
+    """Returns a cached ZipFile for archive_parent, opening it on first use. Returns None on failure."""
+    if archive_parent not in archives:
+        try:
+            archives[archive_parent] = zipfile.ZipFile(archive_parent, 'r')
+        except:
+            logger.exception('Opening archive failed: %s' % archive_parent)
+            archives[archive_parent] = None
+    return archives[archive_parent]
+
+
+def _deletesource(fileobj):
+    """Returns the file to delete for a fileobj: the archive for zip members, otherwise the source file."""
+    return fileobj.archive_parent or fileobj.srcpath
+
+
+def _rootworkers(workers, dest_root):
+    """Returns the concurrency limit for a destination root. Workers is an int or a {dest_root: int} dict."""
+    if isinstance(workers, dict):
+        return max(1, workers.get(dest_root, 1))
+    return max(1, workers or 1)
+
+
+def uploader_copy(fileobjs, deletemode=0, gui=False, verify=True, workers=1, index=None, progress=None, cancel=None,
+                  filedone=None, journal=None):
+    """Copies file objects to device main or card memory. See uploader_prep.
+    Runs 'workers' copies per destination root at once, calling progress and filedone from the copying threads."""
     logger.debug('Starting fileuploader2')
     copycount = 0
+    copiedbytes = 0
+    starttime = time.time()
+    jobs = [f for f in fileobjs if f.process and f.srcpath != f.dest_full]  # prevent copy in place
+    archives = {}  # archive_parent: ZipFile, opened once per run
+    resumed = set()  # id(fileobj) of copies completed by an earlier run
+    verified = set()  # id(fileobj) of copies read back from the device
+    if journal:
+        # removes stale *.tmp files, copies completed by an earlier run are resumed instead of repeated
+        journal.cleantmp(jobs)
+        journal.plan(jobs)
+    try:
+        for fileobj in jobs:
+            if fileobj.zipinfo:
+                _openarchive(archives, fileobj.archive_parent)
+
+        # setting cancel (a threading.Event) aborts running copies, removing their *.tmp files, and skips the
+        # remaining ones; cancelled copies (digest False) count as failed, so their sources are kept
+        def copyprogress(fileobj):
+            if not progress and not cancel:
+                return
+
+            def callback(nbytes):
+                if cancel and cancel.is_set():
+                    raise CopyCancelled(fileobj.dest_full)
+                if progress:
+                    progress(fileobj, nbytes)
+            return callback
+
+        def copyjob(fileobj):
+            # trust mode (verify=False) skips reading copies back, except for sources to delete: the journal
+            # must show their copies verified, so unverified copies of an earlier run are verified when resumed
+            entry = journal.completed(fileobj) if journal else None
+            verifyjob = verify or bool(journal and fileobj.delete)
+            if entry and verifyjob and not entry['verified']:
+                entry = dict(entry, verified=True) if _verifycopy(fileobj.dest_full, entry['digest']) else None
+            if entry:
+                resumed.add(id(fileobj))
+                if entry['verified']:
+                    verified.add(id(fileobj))
+                digest = fileobj.digest = entry['digest']
+                journal.copied(fileobj, digest, entry['verified'])
+                if filedone:
+                    filedone(fileobj, digest)
+                return digest
+            try:
+                if cancel and cancel.is_set():
+                    raise CopyCancelled(fileobj.dest_full)
+                digest = fileobj.do_copyfile(zipf=archives.get(fileobj.archive_parent), verify=verifyjob,
+                                             progress=copyprogress(fileobj))
+            except CopyCancelled:
+                logger.debug('Cancelled: %s' % fileobj.dest_full)
+                digest = False
+            if digest and verifyjob:
+                verified.add(id(fileobj))
+            if journal and digest:
+                try:
+                    journal.copied(fileobj, digest, verifyjob)
+                except OSError:  # e.g. reader unplugged after copying, the source is then kept
+                    logger.exception('Journaling copy failed: %s' % fileobj.dest_full)
+            if filedone:
+                filedone(fileobj, digest)
+            return digest
+
+        def copygroup(group):
+            return [copyjob(fileobj) for fileobj in group]
+
+        # jobs with the same destination (e.g. equally named members of two zips) share a *.tmp file, so they
+        # are copied one after another, in a single task
+        groups = collections.OrderedDict()  # normalized dest_full: jobs
+        for fileobj in jobs:
+            groups.setdefault(os.path.normcase(os.path.abspath(fileobj.dest_full)), []).append(fileobj)
+
+        copied = {}  # id(fileobj): digest
+        # a pool per root: jobs waiting for a busy root mustn't hold threads that another root's jobs could use
+        with contextlib.ExitStack() as stack:
+            pools = dict((root, stack.enter_context(ThreadPoolExecutor(max_workers=_rootworkers(workers, root))))
+                         for root in set(f.dest_root for f in jobs))
+            futures = [(group, pools[group[0].dest_root].submit(copygroup, group)) for group in groups.values()]
+            for group, future in futures:
+                for fileobj, digest in zip(group, future.result()):
+                    copied[id(fileobj)] = digest
+    finally:
+        # close archives before deleting them (Windows)
+        for zipf in archives.values():
+            if zipf:
+                zipf.close()
+
+    # sources are deleted after all copies finished, if every copy from them succeeded (and was journaled verified)
+    failedsources = set(_deletesource(f) for f in jobs if f.delete and not (
+                        copied[id(f)] and (journal is None or (journal.completed(f) or {}).get('verified'))))
     filestodelete = set()
     for fileobj in fileobjs:
-        # logger.debug('paths %s %s' % (fileobj.srcpath, fileobj.dest_full))
-        if fileobj.process and fileobj.srcpath != fileobj.dest_full:  # prevent copy in place
-            copied = fileobj.do_copyfile()
+        if id(fileobj) in copied:
+            digest = copied[id(fileobj)]
             wasdeleted = False
-            if copied:
+            if digest:
                 copycount += 1
-                if fileobj.delete:
+                if id(fileobj) not in resumed:
+                    copiedbytes += fileobj.getsize()
+                if index and id(fileobj) in verified:  # the index only lists copies read back
+                    index.update(fileobj.dest_full, digest, fileobj.zipinfo.CRC if fileobj.zipinfo else None)
+                if fileobj.delete and _deletesource(fileobj) not in failedsources:
                     logger.debug('Deleting %s (if zip of %s)' % (fileobj.srcpath, fileobj.archive_parent))
-                    filestodelete.add(fileobj.srcpath if not fileobj.archive_parent else fileobj.archive_parent)
+                    filestodelete.add(_deletesource(fileobj))
                     wasdeleted = True
 
-            fileobj.setoutcome(copied, 'Copied' if copied else 'Copying or extraction failed', wasdeleted)
+            fileobj.setoutcome(digest, 'Copied earlier (resumed)' if id(fileobj) in resumed else
+                               'Copied' if digest else 'Cancelled' if digest is False else
+                               'Copying or extraction failed', wasdeleted)
         else:
             fileobj.setoutcome(False, fileobj.msg if fileobj.msg and not fileobj.filetype else 'Not copied (user or identical file)', False)
 
+    if index:
+        index.save()
+
     logger.debug('filestodelete: %s' % filestodelete)
     for each in filestodelete:
-        os.remove(each)
+        with runsummary.span('delete', items=1, nbytes=os.path.getsize(each)):
+            os.remove(each)
+        if journal:
+            journal.sourcedeleted(each)
+    if journal:
+        journal.compact()
 
     # [logger.debug('CHECK %s %s' % (x.filename, x.msg)) for x in fileobjs]
     text = ''
@@ -240,6 +1255,12 @@ def uploader_copy(fileobjs, deletemode=0, gui=False):
         prefix, spacing = ('', 40) if x.tocopy else ('! ', 38)
         text += prefix + ' -- '.join((x.dest_filename if gui else x.dest_filename.ljust(spacing), x.msg_outcome)) + '\n'
 
+    elapsed = time.time() - starttime
+    if copycount:
+        # in trust mode, copies of sources to delete are verified nonetheless
+        text += '\nCopied %.1f MB in %.1f s (%.1f MB/s, %d of %d verified)\n' % (
+            copiedbytes / 1e6, elapsed, copiedbytes / 1e6 / elapsed if elapsed else 0, len(verified), copycount)
+
     return text, copycount if gui else text
 
 
@@ -270,27 +1291,41 @@ def _cli_prompt_filename(dest, filename):
                 print('! New filename already exists')
 
 
-def _uploader_getfileobj(filepath, zipenabled=False):
-    """Creates fileobj from filepath or zipfile contents (multiple files). Returns list."""
-    import zipfile
-    fileobjs = []
-    is_zipfile = zipfile.is_zipfile(filepath) if zipenabled else False
+def _uploader_getfileobj(filepath, zipenabled=False, skipped=None):
+    """Yields a fileobj for filepath, or for each supported member of a zip archive (see _scanzip).
+    Files failing _checkfile are counted in the optional skipped Counter, instead of yielding a fileobj."""
+    skipped = collections.Counter() if skipped is None else skipped
+    zipf = None
+    if zipenabled:
+        try:
+            zipf = zipfile.ZipFile(filepath, 'r')
+        except (zipfile.BadZipFile, OSError):
+            pass
 
-    if not is_zipfile:
-        if _checkfile(filepath):
-            fileobjs.append(PbFileref(filepath))
-        else:
-            fileobjs.setstate(False, "Skipped, checkfile failed")
-    elif is_zipfile and zipenabled:
-        with zipfile.ZipFile(filepath, 'r') as zf:
-            for zipinfo in zf.infolist():
-                if not zipinfo.is_dir():
-                    fileobjs.append(PbFileref(filepath, archive_parent=filepath, zipinfo=zipinfo))
+    if zipf:
+        with zipf:
+            yield from _scanzip(zipf, filepath, skipped)
+    elif _checkfile(filepath):
+        yield PbFileref(filepath)
+    else:
+        logger.debug('Skipped %s, checkfile failed' % filepath)
+        skipped['Skipped, checkfile failed'] += 1
 
-    return fileobjs
+
+def _scanzip(zipf, archive_parent, skipped):
+    """Yields fileobjs for the members of an open ZipFile with a supported extension (FORMAT_EXTENSIONS), from
+    its central directory as read on opening. Directories are ignored; other members are only counted in skipped,
+    so archives of thousands of unrelated entries don't create a fileobj (or dialog row) per entry."""
+    for zipinfo in zipf.infolist():
+        if zipinfo.is_dir():
+            continue
+        if os.path.splitext(zipinfo.filename)[1] in FORMAT_EXTENSIONS:
+            yield PbFileref(archive_parent, archive_parent=archive_parent, zipinfo=zipinfo)
+        else:
+            skipped['Skipped, unknown file extension (zip member)'] += 1
 
 
-def _uploader_setdest(fileobj, mainpath, cardpath=None, replace=False, gui=False):
+def _uploader_setdest(fileobj, mainpath, cardpath=None, replace=False, gui=False, index=None, journal=None):
     """Set fileobj destination folder and/or root, and check existence."""
     if cardpath and fileobj.filetype == 'ACSM':
         fileobj.setroot(cardpath, tocard=True)
@@ -302,7 +1337,9 @@ def _uploader_setdest(fileobj, mainpath, cardpath=None, replace=False, gui=False
         return fileobj
 
     if os.path.exists(fileobj.dest_full):
-        if not fileobj.zipinfo and filecmp.cmp(*fileobj()):
+        if journal and journal.completed(fileobj):
+            fileobj.setstate(True, 'Resuming, copied earlier')
+        elif index.identical(fileobj) if index else not fileobj.zipinfo and filecmp.cmp(*fileobj()):
             fileobj.delete = False
             fileobj.setstate(False, 'Skipped, identical file exists')
         elif replace:
@@ -328,116 +1365,825 @@ def _uploader_setdest(fileobj, mainpath, cardpath=None, replace=False, gui=False
     return fileobj
 
 
-def export_htmlhighlights(db, outputfile, sortontitle=False):
-    """Queries a books.db and writes out highlight entries to a HTML file."""
+HIGHLIGHT_COLUMNS = ('Title', 'Authors', 'Highlight', 'Page')
 
-    con = sqlite3.connect(db)
-    # con.row_factory = sqlite3.Row
-    # cur = con.cursor()
-    # query improves upon https://www.mobileread.com/forums/showpost.php?p=3740634&postcount=36
-    query = '''
-        SELECT Title, Authors, Val,
+
+def hasjson1(con):
+    """Returns True if the sqlite library provides the JSON1 functions (missing on older Windows builds)."""
+    try:
+        con.execute("SELECT json_extract('{\"a\": 1}', '$.a')").fetchone()
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
+# query improves upon https://www.mobileread.com/forums/showpost.php?p=3740634&postcount=36
+_HIGHLIGHT_QUERY = '''
+        SELECT t.OID AS OID, Title, Authors, Val,
         CAST(substr(Val, instr(Val,'page=') + 5, (instr(Val,'&') - instr(Val,'page=') - 5)) AS INTEGER) AS Page,
         CAST(substr(Val, instr(Val,'offs=') + 5, (instr(Val,'#') - instr(Val,'offs=') - 5)) AS INTEGER) AS PageOffset
-        from Books b
-        LEFT JOIN (SELECT OID, ParentID from Items WHERE State = 0) i on i.ParentID = b.OID
-        INNER JOIN (SELECT OID, ItemID, Val from Tags where TagID = 104 and Val <> '{"text":"Bookmark"}') t on t.ItemID = i.OID
+        from %(schema)s.Books b
+        LEFT JOIN (SELECT OID, ParentID from %(schema)s.Items WHERE State = 0) i on i.ParentID = b.OID
+        INNER JOIN (SELECT OID, ItemID, Val from %(schema)s.Tags where TagID = 104 and Val <> '{"text":"Bookmark"}'
+                    and OID > ?) t on t.ItemID = i.OID
         '''
 
+
+def _highlightquery(schemas=None, sortontitle=False, json1=False):
+    """Returns the highlight query, taking a minimum Tags OID parameter per schema.
+    Without schemas, queries the main database. With a list of attached schemas, combines their highlights
+    using UNION ALL, and rows start with the schema's index in the list. See _highlightrows for the columns."""
+    if schemas is None:
+        query = _HIGHLIGHT_QUERY % {'schema': 'main'}
+        prefix = ''
+    else:
+        query = 'SELECT * FROM (%s)' % '\n        UNION ALL\n        '.join(
+            'SELECT %d AS SchemaNr, * FROM (%s)' % (nr, _HIGHLIGHT_QUERY % {'schema': schema})
+            for nr, schema in enumerate(schemas))
+        prefix = 'SchemaNr, '
+
+    if json1:
+        query = '''
+        SELECT %sOID, Title, COALESCE(NULLIF(Authors, ''), '-'),
+        CASE WHEN json_type(Val, '$.text') IS NULL THEN '' ELSE json_extract(Val, '$.text') END,
+        CASE WHEN json_type(Val, '$.begin') IS NULL THEN '?' ELSE Page + 1 END
+        FROM (%s)''' % (prefix, query)
+
     if sortontitle:
-        query += '\nORDER BY Title, Authors, Page, PageOffset;'
+        query += '\nORDER BY %sTitle, Authors, Page, PageOffset;' % prefix
+    else:
+        query += '\nORDER BY %sOID;' % prefix
+    return query
+
 
+def _highlightrows(con, sortontitle=False, minoid=0, json1=False, batchsize=EXPORT_BATCHSIZE):
+    """Yields (Tags OID, Title, Authors, Val, Page, PageOffset) highlight rows from a books.db, fetched in batches.
+    Only returns highlights with a Tags OID above minoid.
+    With json1, rows are decoded in SQL into typed (Tags OID, title, authors, highlight, page) columns,
+    identical to the output of _decodehighlights."""
+    query = _highlightquery(sortontitle=sortontitle, json1=json1)
+    return querytrace.rows(con, query, (minoid,), batchsize=batchsize)
+
+
+def _decodehighlight(title, authors, val, page, pageoffset):
+    """Returns a (title, authors, highlight, page) record for a highlight row, without using JSON1."""
+    valdict = json.loads(val)  # circumvents missing json1 ext on Windows
+    # notes app edited highlights lose page & offset
+    return title, authors or '-', valdict.get('text', ''), page + 1 if 'begin' in valdict else '?'
+
+
+def _decodehighlights(rows):
+    """Yields (title, authors, highlight, page) records from highlight rows, without using JSON1."""
+    for row in rows:
+        yield _decodehighlight(*row)
+
+
+def _format_html(records, header=True, columns=HIGHLIGHT_COLUMNS):
+    if header:
+        yield '<HTML><head><meta charset="utf-8" /><style>td {vertical-align: top;}</style></head><BODY><TABLE>\n'
+        yield '<TR>%s</TR>\n' % ''.join('<TH>%s</TH>' % column for column in columns)
+    for record in records:
+        yield '<tr>%s</tr>\n' % ''.join('<td>%s</td>' % html.escape(str(field)).replace('\n', '<br />')
+                                        for field in record)
+    yield '</TABLE></BODY></HTML>'
+
+
+def _format_csv(records, header=True, columns=HIGHLIGHT_COLUMNS):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(columns)
+    for record in records:
+        writer.writerow(record)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _format_jsonl(records, header=True, columns=HIGHLIGHT_COLUMNS):
+    columns = [column.lower() for column in columns]
+    for record in records:
+        yield json.dumps(dict(zip(columns, record)), ensure_ascii=False) + '\n'
+
+
+def _format_markdown(records, header=True, columns=HIGHLIGHT_COLUMNS):
+    if header:
+        yield '| %s |\n' % ' | '.join(columns)
+        yield '|%s\n' % (' --- |' * len(columns))
+    for record in records:
+        yield '| %s |\n' % ' | '.join(str(field).replace('|', '\\|').replace('\n', '<br />') for field in record)
+
+
+# format: (label, file extensions, formatter)
+HIGHLIGHT_FORMATS = {
+    'html': ('HTML', ('html', 'htm'), _format_html),
+    'csv': ('CSV', ('csv',), _format_csv),
+    'jsonl': ('JSON Lines', ('jsonl',), _format_jsonl),
+    'md': ('Markdown', ('md',), _format_markdown),
+}
+
+
+def _exportmarker(outputfile):
+    return outputfile + '.pbt-export.json'
+
+
+def _loadexportmarker(db, outputfile, fmt, sortontitle):
+    """Returns the export marker if outputfile can be appended to: unmodified since the last export
+    of the same db and format, and not sorted on title. Otherwise returns None."""
+    markerpath = _exportmarker(outputfile)
+    if sortontitle or not os.path.exists(markerpath) or not os.path.exists(outputfile):
+        return
+    try:
+        with open(markerpath, 'r') as fin:
+            marker = json.load(fin)
+    except ValueError:
+        return
+    if marker.get('db') != os.path.abspath(db) or marker.get('fmt') != fmt or \
+            marker.get('size') != os.path.getsize(outputfile):
+        return
+    return marker
+
+
+def export_highlights(db, outputfile, fmt='html', sortontitle=False, incremental=False, json1=None, usecopy=False):
+    """Streams a books.db's highlights to a file in one of HIGHLIGHT_FORMATS, using constant memory:
+    batched reader -> row decoder -> formatter -> buffered writer. Returns the number of highlights written.
+    With incremental, only highlights newer than the recorded high-water mark (max Tags OID) are appended
+    to the existing file. If the marker is missing or outdated, the file is rebuilt. The marker is only written
+    (next to the file) by incremental exports, other exports remove an outdated one.
+    Highlights are decoded in SQL if JSON1 is available (json1=None detects this), otherwise in Python.
+    Records the 'export' span, which includes fetching the rows ('export.query') and rendering them.
+    With usecopy, queries run against a local working copy with helper indexes (see workingcopy)."""
+    formatter = HIGHLIGHT_FORMATS[fmt][2]
+    marker = _loadexportmarker(db, outputfile, fmt, sortontitle) if incremental else None
+    minoid = marker['maxoid'] if marker else 0
+    maxoid = minoid
     highlightcount = 0
-    with open(outputfile, 'wt') as out:
-        out.write('<HTML><head><style>td {vertical-align: top;}</style></head><BODY><TABLE>\n')
-        out.write("<TR><TH>Title</TH>"
-                  "<TH>Authors</TH>"
-                  "<TH>Highlight</TH>"
-                  "<TH>Page</TH>"
-                  "</TR>\n")
-        for title, authors, val, page, pageoffset in con.execute(query):
-            valdict = json.loads(val)
-            highlight = valdict.get('text', '').replace('\n', '<br />')  # circumvents missing json1 ext on Windows
-            # notes app edited highlights lose page & offset
-            if 'begin' in valdict:
-                page += 1
-            else:
-                page = '?'
-            htmlrow = "<tr><td>{0}</td><td>{1}</td><td>{2}</td><td>{3}</td></tr>\n".format(title, authors or '-', highlight, page)
-            out.write(htmlrow)
+
+    def tracked(rows):
+        nonlocal highlightcount, maxoid
+        for row in rows:
             highlightcount += 1
-        out.write('</TABLE></BODY></HTML>')
+            maxoid = max(maxoid, row[0])
+            yield row[1:]
 
-    con.close()
+    if marker:
+        # strip the trailer, to append new rows
+        trailer = ''.join(formatter(iter(()), header=False)).encode('utf-8')
+        os.truncate(outputfile, marker['size'] - len(trailer))
+        logger.debug('Appending highlights with OID > %d to %s' % (minoid, outputfile))
+
+    with workingcopy(db) if usecopy else contextlib.nullcontext(db) as querydb:
+        con = sqlite_connect_ro(querydb)
+        try:
+            if json1 is None:
+                json1 = hasjson1(con)
+            records = tracked(runsummary.timed('export.query', _highlightrows(con, sortontitle, minoid=minoid,
+                                                                               json1=json1)))
+            if not json1:
+                records = _decodehighlights(records)
+            with runsummary.span('export') as counters:
+                with open(outputfile, 'a' if marker else 'w', encoding='utf-8', newline='', buffering=EXPORT_BUFFERSIZE) as out:
+                    out.writelines(formatter(records, header=not marker))
+                counters['items'] = highlightcount
+                counters['bytes'] = os.path.getsize(outputfile)
+        finally:
+            con.close()
+
+    if incremental:
+        _writejson(_exportmarker(outputfile), {'db': os.path.abspath(db), 'fmt': fmt, 'maxoid': maxoid,
+                                               'size': os.path.getsize(outputfile)})
+    elif os.path.exists(_exportmarker(outputfile)):
+        os.remove(_exportmarker(outputfile))
     return highlightcount
 
 
-def mergefix_annotations(dbpath):
-    """Merge/fixes annotations for a given books.db, by modifying Parent_ID values of Item table rows."""
-    query_dupes = '''
-                SELECT * FROM(
-                    SELECT Title, Authors,
-                    COUNT(*) OVER (PARTITION BY Title, Authors) AS COUNTS,
-                    OID,
-                    MAX(OID) OVER (PARTITION BY Title, Authors) AS MAXOID
-                    FROM Books ORDER BY Title, Authors, OID DESC
-                ) WHERE COUNTS > 1
-                    '''
+def export_htmlhighlights(db, outputfile, sortontitle=False):
+    """Queries a books.db and writes out highlight entries to a HTML file."""
+    return export_highlights(db, outputfile, fmt='html', sortontitle=sortontitle)
+
+
+class ProfileDbs:
+    """Read-only connections with the books.db of every profile (main memory and card) attached,
+    answering cross-profile queries in one pass per connection, using UNION ALL with a profile column.
+    Sqlite limits attached databases (10 by default), so each connection attaches up to PROFILEDBS_ATTACHED."""
+    def __init__(self, bookdbs):
+        self.bookdbs = [(profile, path) for profile, path in bookdbs if os.path.exists(path)]
+        self.groups = []  # (connection, index of its first books.db, schemas)
+        try:
+            for offset in range(0, len(self.bookdbs), PROFILEDBS_ATTACHED):
+                con = sqlite3.connect(':memory:', uri=True)  # uri: ATTACH then accepts read-only URIs
+                schemas = []
+                self.groups.append((con, offset, schemas))
+                for nr, (profile, path) in enumerate(self.bookdbs[offset:offset + PROFILEDBS_ATTACHED]):
+                    schemas.append('p%d' % nr)
+                    con.execute('ATTACH DATABASE ? AS %s' % schemas[-1],
+                                ('file:%s?mode=ro' % pathname2url(os.path.abspath(path)),))
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for con, offset, schemas in self.groups:
+            con.close()
+        self.groups = []
+
+    @staticmethod
+    def _union(query, offset, schemas):
+        return '\nUNION ALL\n'.join(query % {'nr': offset + nr, 'schema': schema} for nr, schema in enumerate(schemas))
+
+    def stats(self):
+        """Returns a list of (profile, books.db path, stats) tuples, see _dbstats."""
+        query = '''
+            SELECT %(nr)d, COUNT(*), COALESCE(SUM(Val <> 'bookmark'), 0), COALESCE(SUM(Val = 'bookmark'), 0),
+            (SELECT COUNT(*) FROM (SELECT OID FROM %(schema)s.Books GROUP BY Title, Authors HAVING COUNT(*) > 1))
+            FROM %(schema)s.Tags WHERE TagID = 102'''
+        out = []
+        for con, offset, schemas in self.groups:
+            for nr, annotations, highlights, bookmarks, titledupes in querytrace.execute(
+                    con, self._union(query, offset, schemas)):
+                profile, path = self.bookdbs[nr]
+                out.append((profile, path, {'annotations': annotations, 'highlights': highlights,
+                                            'bookmarks': bookmarks, 'titledupes': titledupes}))
+        return out
+
+    def duplicates(self):
+        """Yields (profile, books.db path, title, authors, entries) for duplicate Books entries of all profiles."""
+        query = '''
+            SELECT %(nr)d, Title, Authors, COUNT(*) FROM %(schema)s.Books
+            GROUP BY Title, Authors HAVING COUNT(*) > 1'''
+        for con, offset, schemas in self.groups:
+            for nr, title, authors, entries in querytrace.execute(
+                    con, self._union(query, offset, schemas) + '\nORDER BY 1, 2, 3'):
+                profile, path = self.bookdbs[nr]
+                yield profile, path, title, authors, entries
+
+    def highlights(self, sortontitle=False, json1=None, batchsize=EXPORT_BATCHSIZE):
+        """Yields (profile, title, authors, highlight, page) records of all profiles, ordered per profile."""
+        if not self.groups:
+            return
+        if json1 is None:
+            json1 = hasjson1(self.groups[0][0])
+        for con, offset, schemas in self.groups:
+            query = _highlightquery(schemas, sortontitle=sortontitle, json1=json1)
+            rows = querytrace.rows(con, query, (0,) * len(schemas), batchsize=batchsize)
+            profiles = [profile for profile, path in self.bookdbs[offset:offset + len(schemas)]]
+            for row in rows:
+                yield (profiles[row[0]],) + (row[2:] if json1 else _decodehighlight(*row[2:]))
+
+
+def export_device_highlights(bookdbs, outputfile, fmt='html', sortontitle=False, json1=None):
+    """Exports the highlights of all profile books.db files to a single file in one pass, adding a Profile column.
+    Returns the number of highlights written. Unlike export_highlights, does not support incremental exports."""
+    formatter = HIGHLIGHT_FORMATS[fmt][2]
+    highlightcount = 0
 
-    query_update = "UPDATE Items SET ParentID = ? WHERE ParentID = ?"
+    def counted(records):
+        nonlocal highlightcount
+        for record in records:
+            highlightcount += 1
+            yield record
+
+    with ProfileDbs(bookdbs) as dbs, runsummary.span('export') as counters:
+        records = counted(runsummary.timed('export.query', dbs.highlights(sortontitle=sortontitle, json1=json1)))
+        with open(outputfile, 'w', encoding='utf-8', newline='', buffering=EXPORT_BUFFERSIZE) as out:
+            out.writelines(formatter(records, columns=('Profile',) + HIGHLIGHT_COLUMNS))
+        counters['items'] = highlightcount
+        counters['bytes'] = os.path.getsize(outputfile)
+    return highlightcount
 
-    con = sqlite3.connect(dbpath)
-    cursorupdate = con.cursor()
 
-    report = ''
-    for title, authors, count, oid, maxoid in con.execute(query_dupes):
-        reportline = ''
-        if count < 2:
-            continue
-        elif oid == maxoid:
-            report += '\n'
-            reportline = 'Checking title \'%s\' by \'%s\' (max oid: %s)' % (title, authors, maxoid)
-        elif oid < maxoid:
-            result = cursorupdate.execute(query_update, (maxoid, oid))
-            if result.rowcount:
-                reportline = '- Changed %d rows, setting Item\'s ParentID from %s to %s (for \'%s\')'\
-                             % (result.rowcount, oid, maxoid, title)
-            else:
-                reportline = '- Nothing to change for oid %s (\'%s\')' % (oid, title)
+class AnnotationMirror:
+    """Host-side mirror of a device's profile books.db files, so exports and stats run from local storage,
+    also while the device is disconnected. Each books.db is mirrored to a sqlite file with the Books, Items and
+    Tags columns used by this module, so the mirror paths can be used wherever a books.db path is expected.
+    Syncs copy Books entirely, and only new or changed Items/Tags rows: OID above, or edit time at or above,
+    the watermark of the previous sync. Rows deleted on the device are detected by comparing row counts.
+    Changes that don't update edit times (such as mergefix_annotations) need a full sync: see invalidate."""
+    FILENAME = 'mirror.json'
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS Books (OID INTEGER PRIMARY KEY, Title TEXT, Authors TEXT);
+        CREATE TABLE IF NOT EXISTS Items (OID INTEGER PRIMARY KEY, ParentID INTEGER, State INTEGER, TimeAlt INTEGER);
+        CREATE TABLE IF NOT EXISTS Tags (OID INTEGER PRIMARY KEY, ItemID INTEGER, TagID INTEGER, Val TEXT,
+                                         TimeEdt INTEGER);
+        CREATE INDEX IF NOT EXISTS pbt_items_parentid ON Items(ParentID);
+        CREATE INDEX IF NOT EXISTS pbt_tags_itemid ON Tags(ItemID);
+        CREATE TABLE IF NOT EXISTS pbt_sync (key TEXT PRIMARY KEY, value);
+        '''
+    # table: (columns, edit time column)
+    TABLES = collections.OrderedDict((
+        ('Items', (('OID', 'ParentID', 'State', 'TimeAlt'), 'TimeAlt')),
+        ('Tags', (('OID', 'ItemID', 'TagID', 'Val', 'TimeEdt'), 'TimeEdt')),
+    ))
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.isdir(root):
+            os.makedirs(root)
+
+    @classmethod
+    def for_device(cls, explorerdbpath, statedir=None):
+        statedir = statedir or hoststatedir()
+        return cls(os.path.join(statedir, 'mirror-%s' % devicekey(explorerdbpath)))
+
+    @classmethod
+    def last(cls, statedir=None):
+        """Returns the most recently synced mirror, or None."""
+        statedir = statedir or hoststatedir()
+        synced = []
+        for name in os.listdir(statedir):
+            path = os.path.join(statedir, name, cls.FILENAME)
+            if name.startswith('mirror-') and os.path.exists(path):
+                with open(path, 'r') as fin:
+                    synced.append((json.load(fin).get('synced', 0), os.path.join(statedir, name)))
+        return cls(max(synced)[1]) if synced else None
+
+    @property
+    def devicekey(self):
+        """Returns the devicekey of the mirrored device."""
+        return os.path.basename(os.path.normpath(self.root))[len('mirror-'):]
+
+    @staticmethod
+    def _sourcekey(bookdbpath):
+        return hashlib.sha1(os.path.normcase(os.path.abspath(bookdbpath)).encode('utf-8')).hexdigest()[:8]
+
+    @classmethod
+    def invalidate(cls, bookdbpath, statedir=None):
+        """Clears the sync state of the mirrors of a books.db, in all device mirrors, so their next sync is a
+        full one. Returns the number of mirror files invalidated."""
+        statedir = statedir or hoststatedir()
+        suffix = '-%s.db' % cls._sourcekey(bookdbpath)
+        count = 0
+        for name in os.listdir(statedir):
+            root = os.path.join(statedir, name)
+            if not name.startswith('mirror-') or not os.path.isdir(root):
+                continue
+            for filename in os.listdir(root):
+                if filename.endswith(suffix):
+                    con = sqlite3.connect(os.path.join(root, filename))
+                    try:
+                        with con:
+                            con.execute("DELETE FROM pbt_sync WHERE key != 'source'")
+                        count += 1
+                    except sqlite3.Error:
+                        logger.exception('Invalidating mirror failed: %s' % filename)
+                    finally:
+                        con.close()
+        return count
+
+    def mirrorpath(self, profile, bookdbpath):
+        return os.path.join(self.root, '%s-%s.db' % (re.sub(r'[^\w.-]', '_', profile), self._sourcekey(bookdbpath)))
+
+    def bookdbs(self):
+        """Returns (profile, mirror path) pairs of the last sync, like the bookdbs of discover_device."""
+        manifest = os.path.join(self.root, self.FILENAME)
+        if not os.path.exists(manifest):
+            return []
+        with open(manifest, 'r') as fin:
+            return [(profile, path) for profile, path in json.load(fin)['bookdbs'] if os.path.exists(path)]
+
+    def sync(self, bookdbs, full=False):
+        """Syncs the (profile, books.db path) pairs of a device. Returns a list of (profile, path, result)
+        tuples, where result counts the copied 'books', 'items' and 'tags' rows, or is None if unchanged."""
+        out = []
+        mirrored = []
+        with runsummary.span('mirror.sync') as counters:
+            for profile, path in bookdbs:
+                if not os.path.exists(path):
+                    continue
+                mirrorpath = self.mirrorpath(profile, path)
+                result = self._syncdb(path, mirrorpath, full)
+                out.append((profile, path, result))
+                mirrored.append((profile, mirrorpath))
+                counters['items'] += sum(result.values()) if result else 0
+        _writejson(os.path.join(self.root, self.FILENAME), {'synced': time.time(), 'bookdbs': mirrored})
+        return out
+
+    def _syncdb(self, srcpath, mirrorpath, full=False):
+        fingerprint = json.dumps(dbfingerprint(srcpath), sort_keys=True)
+        con = sqlite3.connect(mirrorpath, isolation_level=None, uri=True)  # uri: ATTACH accepts read-only URIs
+        try:
+            con.executescript(self.SCHEMA)
+            state = dict(con.execute('SELECT key, value FROM pbt_sync'))
+            if not full and state.get('fingerprint') == fingerprint:
+                return
+            con.execute('ATTACH DATABASE ? AS device', ('file:%s?mode=ro' % pathname2url(os.path.abspath(srcpath)),))
+            con.execute('BEGIN IMMEDIATE')
+            con.execute('DELETE FROM main.Books')
+            result = {'books': con.execute('INSERT INTO main.Books SELECT OID, Title, Authors FROM device.Books').rowcount}
+            for table, (columns, timecolumn) in self.TABLES.items():
+                result[table.lower()] = self._synctable(con, table, columns, timecolumn, state, full)
+            con.execute('INSERT OR REPLACE INTO pbt_sync VALUES (?, ?)', ('fingerprint', fingerprint))
+            con.execute('INSERT OR REPLACE INTO pbt_sync VALUES (?, ?)', ('source', os.path.abspath(srcpath)))
+            con.execute('COMMIT')
+        except:
+            if con.in_transaction:
+                con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
+        logger.debug('Mirrored %s: %s' % (srcpath, result))
+        return result
+
+    def _synctable(self, con, table, columns, timecolumn, state, full=False):
+        """Copies new or changed rows of a device table, updating its watermark. Returns the number of rows copied."""
+        devicecolumns = set(row[1] for row in con.execute('PRAGMA device.table_info(%s)' % table))
+        hastime = timecolumn in devicecolumns
+        select = ', '.join(column if column in devicecolumns else 'NULL' for column in columns)
+        maxoid, maxtime = state.get(table + '.maxoid'), state.get(table + '.maxtime')
+        if full or maxoid is None:
+            con.execute('DELETE FROM main.%s' % table)
+            query, params = 'SELECT %s FROM device.%s' % (select, table), ()
+        elif hastime and maxtime is not None:
+            query, params = 'SELECT %s FROM device.%s WHERE OID > ? OR %s >= ?' % (select, table, timecolumn), \
+                            (maxoid, maxtime)
         else:
-            logger.debug("! Unknown issue for %s %s %s %s" % (title, authors, oid, maxoid))
+            query, params = 'SELECT %s FROM device.%s WHERE OID > ?' % (select, table), (maxoid,)
+        copied = querytrace.execute(con, 'INSERT OR REPLACE INTO main.%s (%s) %s' % (
+            table, ', '.join(columns), query), params).rowcount
+
+        # rows deleted on the device
+        if con.execute('SELECT COUNT(*) FROM main.%s' % table).fetchone()[0] != \
+                con.execute('SELECT COUNT(*) FROM device.%s' % table).fetchone()[0]:
+            con.execute('DELETE FROM main.%s WHERE OID NOT IN (SELECT OID FROM device.%s)' % (table, table))
+
+        maxoid, maxtime = con.execute('SELECT COALESCE(MAX(OID), 0), MAX(%s) FROM main.%s' % (
+            timecolumn, table)).fetchone()
+        con.executemany('INSERT OR REPLACE INTO pbt_sync VALUES (?, ?)',
+                        ((table + '.maxoid', maxoid), (table + '.maxtime', maxtime)))
+        return copied
 
-        if reportline:
-            report += reportline + '\n'
-            logger.debug(reportline)
 
-    con.commit()
-    changedrows = con.total_changes
-    reportline = '\nTotal rows changed: %s\n\n' % changedrows
-    report += reportline
-    logger.debug(reportline)
+SearchResult = collections.namedtuple('SearchResult', 'profile title authors highlight page snippet')
+
+
+class HighlightIndex:
+    """Host-side FTS5 full-text index of highlight text, title and authors, for the profile books.db files of a
+    device. Rows come from the same query as export_highlights. Sources are keyed by device key and profile, so
+    a profile's device and mirror paths share their indexed rows. Updates skip unchanged databases by
+    fingerprint, and only add highlights above the indexed Tags OID. A database is reindexed when its number
+    of highlights no longer matches (deleted or merged annotations), or on rebuild."""
+    FILENAME = 'highlightindex.db'
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sources (id INTEGER PRIMARY KEY, device TEXT, profile TEXT, path TEXT,
+                                            maxoid INTEGER, fingerprint TEXT, UNIQUE (device, profile));
+        CREATE TABLE IF NOT EXISTS highlights (id INTEGER PRIMARY KEY, source INTEGER, oid INTEGER, title TEXT,
+                                               authors TEXT, text TEXT, page);
+        CREATE INDEX IF NOT EXISTS highlights_source ON highlights(source);
+        CREATE VIRTUAL TABLE IF NOT EXISTS highlights_fts USING fts5(
+            text, title, authors, content='highlights', content_rowid='id', tokenize='unicode61 remove_diacritics 2');
+        CREATE TRIGGER IF NOT EXISTS highlights_ai AFTER INSERT ON highlights BEGIN
+            INSERT INTO highlights_fts(rowid, text, title, authors) VALUES (new.id, new.text, new.title, new.authors);
+        END;
+        CREATE TRIGGER IF NOT EXISTS highlights_ad AFTER DELETE ON highlights BEGIN
+            INSERT INTO highlights_fts(highlights_fts, rowid, text, title, authors)
+            VALUES ('delete', old.id, old.text, old.title, old.authors);
+        END;
+        '''
 
-    con.close()
+    def __init__(self, path=None):
+        self.path = path or os.path.join(hoststatedir(), self.FILENAME)
+        self.con = sqlite3.connect(self.path, check_same_thread=False)
+        columns = [row[1] for row in self.con.execute('PRAGMA table_info(sources)')]
+        if columns and 'device' not in columns:  # sources keyed by path, the index is rebuilt
+            self.con.executescript('DROP TABLE sources; DROP TABLE highlights_fts; DROP TABLE highlights;')
+        self.con.executescript(self.SCHEMA)
+
+    def close(self):
+        self.con.close()
+
+    def update(self, bookdbs, device, rebuild=False):
+        """Indexes the highlights of (profile, books.db path) pairs of a device (see devicekey), from the device
+        or its mirror. Removes the sources of other devices, and of profiles not in bookdbs, so the index holds
+        a single device. Returns the number of highlights added."""
+        added = 0
+        with runsummary.span('search.update') as counters:
+            keep = set()
+            for profile, path in bookdbs:
+                if os.path.exists(path):
+                    added += self._updatedb(device, profile, path, rebuild)
+                    keep.add(profile)
+            stale = [(sourceid,) for sourceid, sourcedevice, profile in
+                     self.con.execute('SELECT id, device, profile FROM sources')
+                     if sourcedevice != device or profile not in keep]
+            if stale:
+                with self.con:
+                    self.con.executemany('DELETE FROM highlights WHERE source = ?', stale)
+                    self.con.executemany('DELETE FROM sources WHERE id = ?', stale)
+            counters['items'] = added
+        return added
+
+    def _updatedb(self, device, profile, path, rebuild=False):
+        path = os.path.abspath(path)
+        fingerprint = json.dumps(dbfingerprint(path), sort_keys=True)
+        row = self.con.execute('SELECT id, maxoid, fingerprint FROM sources WHERE device = ? AND profile = ?',
+                               (device, profile)).fetchone()
+        if row and row[2] == fingerprint and not rebuild:
+            return 0
+
+        src = sqlite_connect_ro(path)
+        try:
+            with self.con:
+                if row:
+                    sourceid, maxoid = row[:2]
+                    self.con.execute('UPDATE sources SET path = ? WHERE id = ?', (path, sourceid))
+                else:
+                    sourceid = self.con.execute('INSERT INTO sources (device, profile, path, maxoid) '
+                                                'VALUES (?, ?, ?, 0)', (device, profile, path)).lastrowid
+                    maxoid = 0
+                if rebuild:
+                    self.con.execute('DELETE FROM highlights WHERE source = ?', (sourceid,))
+                    maxoid = 0
+                added, maxoid = self._insert(src, sourceid, maxoid)
+
+                indexed = self.con.execute('SELECT COUNT(*) FROM highlights WHERE source = ?', (sourceid,)).fetchone()[0]
+                query = _HIGHLIGHT_QUERY % {'schema': 'main'}
+                count = src.execute('SELECT COUNT(*) FROM (%s)' % query, (0,)).fetchone()[0]
+                if indexed != count:
+                    # highlights were deleted, or restored below the watermark: drop stale rows, reindex if incomplete
+                    oids = set(oid for oid, in src.execute('SELECT OID FROM (%s)' % query, (0,)))
+                    stale = [(rowid,) for rowid, oid in self.con.execute(
+                        'SELECT id, oid FROM highlights WHERE source = ?', (sourceid,)) if oid not in oids]
+                    self.con.executemany('DELETE FROM highlights WHERE id = ?', stale)
+                    if indexed - len(stale) != count:
+                        logger.debug('Reindexing %s: %d highlights indexed, %d in database' % (path, indexed, count))
+                        self.con.execute('DELETE FROM highlights WHERE source = ?', (sourceid,))
+                        added, maxoid = self._insert(src, sourceid, 0)
+                self.con.execute('UPDATE sources SET maxoid = ?, fingerprint = ? WHERE id = ?',
+                                 (maxoid, fingerprint, sourceid))
+        finally:
+            src.close()
+        logger.debug('Indexed %d highlights of %s' % (added, path))
+        return added
+
+    def _insert(self, src, sourceid, minoid):
+        """Inserts the highlights of src above minoid. Returns the number added and the new maximum OID."""
+        json1 = hasjson1(src)
+        added = 0
+        maxoid = minoid
+        batch = []
+        for row in _highlightrows(src, minoid=minoid, json1=json1):
+            title, authors, text, page = row[1:] if json1 else _decodehighlight(*row[1:])
+            batch.append((sourceid, row[0], title, authors, text, page))
+            maxoid = max(maxoid, row[0])
+            if len(batch) == EXPORT_BATCHSIZE:
+                added += len(batch)
+                self.con.executemany('INSERT INTO highlights (source, oid, title, authors, text, page) '
+                                     'VALUES (?, ?, ?, ?, ?, ?)', batch)
+                batch = []
+        added += len(batch)
+        self.con.executemany('INSERT INTO highlights (source, oid, title, authors, text, page) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', batch)
+        return added, maxoid
+
+    def search(self, query, profile=None, limit=SEARCH_LIMIT, raw=False):
+        """Returns up to limit SearchResult tuples, best matches first (bm25, weighing highlight text over title
+        over authors). Words in query must all match, as prefixes; raw passes FTS5 query syntax unchanged."""
+        if not raw:
+            query = ' '.join('"%s"*' % word.replace('"', '""') for word in query.split())
+        if not query:
+            return []
+        sql = '''
+            SELECT s.profile, h.title, h.authors, h.text, h.page, snippet(highlights_fts, 0, '[', ']', '…', 16)
+            FROM highlights_fts JOIN highlights h ON h.id = highlights_fts.rowid JOIN sources s ON s.id = h.source
+            WHERE highlights_fts MATCH ?%s
+            ORDER BY bm25(highlights_fts, 10.0, 5.0, 2.0) LIMIT ?''' % (' AND s.profile = ?' if profile else '')
+        params = (query, profile, limit) if profile else (query, limit)
+        with runsummary.span('search.query') as counters:
+            results = [SearchResult(*row) for row in querytrace.execute(self.con, sql, params)]
+            counters['items'] = len(results)
+        return results
+
+
+def search(query, profile=None, limit=SEARCH_LIMIT, index=None):
+    """Searches the highlight index (see HighlightIndex), optionally for a single profile.
+    Returns up to limit SearchResult tuples, best matches first."""
+    if index is not None:
+        return index.search(query, profile, limit)
+    index = HighlightIndex()
+    try:
+        return index.search(query, profile, limit)
+    finally:
+        index.close()
+
+
+MergeRow = collections.namedtuple('MergeRow', 'title authors oldoid newoid items')
+
+
+_MERGEFIX_PLAN = '''
+    INSERT INTO temp.pbt_merge (oldoid, newoid, title, authors)
+    SELECT OID, MAXOID, Title, Authors FROM(
+        SELECT Title, Authors,
+        OID,
+        MAX(OID) OVER (PARTITION BY Title, Authors) AS MAXOID
+        FROM Books
+    ) WHERE OID < MAXOID
+    '''
+
+_MERGEFIX_PLANROWS = '''
+    SELECT m.title, m.authors, m.oldoid, m.newoid, COALESCE(c.items, 0)
+    FROM temp.pbt_merge m LEFT JOIN (
+        SELECT ParentID, COUNT(*) AS items FROM Items
+        WHERE ParentID IN (SELECT oldoid FROM temp.pbt_merge) GROUP BY ParentID
+    ) c ON c.ParentID = m.oldoid
+    ORDER BY m.title, m.authors, m.oldoid DESC
+    '''
+
+_MERGEFIX_UPDATE = '''
+    UPDATE Items SET ParentID = (SELECT newoid FROM temp.pbt_merge WHERE oldoid = Items.ParentID)
+    WHERE ParentID IN (SELECT oldoid FROM temp.pbt_merge)
+    '''
+
+
+def _mergefix_plan(con, plan=None):
+    """Fills the temp.pbt_merge mapping table, computed from Books or copied from a given plan.
+    Returns the plan."""
+    con.execute('CREATE TEMP TABLE pbt_merge (oldoid INTEGER PRIMARY KEY, newoid INTEGER, title, authors)')
+    if plan is not None:
+        con.executemany('INSERT INTO temp.pbt_merge (oldoid, newoid, title, authors) VALUES (?, ?, ?, ?)',
+                        [(row.oldoid, row.newoid, row.title, row.authors) for row in plan])
+        return plan
+    querytrace.execute(con, _MERGEFIX_PLAN)
+    return [MergeRow(*row) for row in querytrace.execute(con, _MERGEFIX_PLANROWS)]
+
+
+def mergefix_annotations(dbpath, dryrun=False, usecopy=False, statedir=None):
+    """Merge/fixes annotations for a given books.db, by modifying ParentID values of Item table rows.
+    Duplicate Books entries (same Title and Authors) are mapped to their highest OID in a temp table,
+    which is applied using a single UPDATE in one transaction. With dryrun, nothing is written.
+    With usecopy, the plan is computed on a local working copy with helper indexes (see workingcopy),
+    and recomputed on the device only if the database changed in the meantime.
+    As the changed rows keep their edit times, mirrors of the database (see AnnotationMirror, in statedir) are
+    invalidated, so their next sync is a full one.
+    Returns the plan as a list of MergeRow (one per duplicate book OID) and the number of changed rows."""
+    plan = None
+    if usecopy:
+        fingerprint = dbfingerprint(dbpath)
+        with runsummary.span('mergefix.workingcopy'), workingcopy(dbpath) as localdb:
+            localcon = sqlite3.connect(localdb)
+            try:
+                plan = _mergefix_plan(localcon)
+            finally:
+                localcon.close()
+        if dryrun:
+            return plan, 0
+
+    with runsummary.span('mergefix') as counters:
+        con = sqlite3.connect(dbpath, isolation_level=None)
+        try:
+            # lock out writers between planning and updating; a dry run only reads
+            con.execute('BEGIN' if dryrun else 'BEGIN IMMEDIATE')
+            if plan is not None and dbfingerprint(dbpath) != fingerprint:
+                logger.debug('%s changed since planning on working copy, planning again' % dbpath)
+                plan = None
+            plan = _mergefix_plan(con, plan)
+            changedrows = 0
+            if not dryrun:
+                changedrows = querytrace.execute(con, _MERGEFIX_UPDATE).rowcount
+                counters['items'] = changedrows
+            con.execute('ROLLBACK' if dryrun else 'COMMIT')
+        except:
+            if con.in_transaction:
+                con.execute('ROLLBACK')
+            raise
+        finally:
+            con.close()
 
-    return report, changedrows
+    if changedrows:
+        AnnotationMirror.invalidate(dbpath, statedir)
+    logger.debug('%s: %d duplicate book entries, %d rows changed' % (dbpath, len(plan), changedrows))
+    return plan, changedrows
+
+
+def mergefix_report(plan, dryrun=False):
+    """Returns a text report for a mergefix_annotations plan."""
+    report = ''
+    lastbook = None
+    for row in plan:
+        if (row.title, row.authors) != lastbook:
+            lastbook = (row.title, row.authors)
+            report += '\nChecking title \'%s\' by \'%s\' (max oid: %s)\n' % (row.title, row.authors, row.newoid)
+        if row.items:
+            report += '- %s %d rows, setting Item\'s ParentID from %s to %s (for \'%s\')\n' \
+                      % ('Would change' if dryrun else 'Changed', row.items, row.oldoid, row.newoid, row.title)
+        else:
+            report += '- Nothing to change for oid %s (\'%s\')\n' % (row.oldoid, row.title)
+    report += '\nTotal rows %s: %s\n\n' % ('to change' if dryrun else 'changed', sum(row.items for row in plan))
+    return report
 
 
 if __name__ == "__main__":
-    import argparse
+    import argparse, sys
+
+    description = "Tools for a mounted Pocketbook e-reader. Without a command, 'upload' is assumed."
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-v', '--debug', dest='debug', action='store_true', help='Print debug output')
+    common.add_argument('--queryplan', action='store_true',
+                        help='Print query plans and timings of the database queries afterwards')
+    common.add_argument('--summary', action='store_true',
+                        help='Print a JSON summary of phase timings and counters afterwards')
 
-    # CLI currently supports only fileuploader
-    description = "Uploads .acsm or font/dict/pbi/app files to a mounted Pocketbook e-reader. " \
-                  "If cardpath is provided, .acsm files are copied there."
     parser = argparse.ArgumentParser(description=description)
-    parser.add_argument('-v', '--debug', dest='debug', action='store_true', help='Print debug output')
-    parser.add_argument('-z', '--zip', dest='zipenabled', action='store_true', help='Enable experimental zip support')
-    parser.add_argument('-a', '--alwaysreplace', dest='replace', action='store_true', help='Enable support')
-    parser.add_argument('-m', '--mainpath', required=True, help='Path to mounted Pocketbook e-reader root')
-    parser.add_argument('-c', '--cardpath', required=False,
-                        help='Optional path to a mounted SD card of a Pocketbook reader, for copying .acsm files')
-    parser.add_argument('-i', '--files', dest='files', required=True, nargs='*',
-                        help='One or more .acsm/.ttf/.otf/.app/.dict/.pbi files')
-    args = parser.parse_args()
+    subparsers = parser.add_subparsers(dest='command')
+
+    parser_upload = subparsers.add_parser('upload', parents=[common],
+                                          help="Uploads .acsm or font/dict/pbi/app files to a mounted Pocketbook "
+                                               "e-reader. If cardpath is provided, .acsm files are copied there.")
+    parser_upload.add_argument('-z', '--zip', dest='zipenabled', action='store_true', help='Enable experimental zip support')
+    parser_upload.add_argument('-a', '--alwaysreplace', dest='replace', action='store_true', help='Enable support')
+    parser_upload.add_argument('-t', '--trust', dest='trust', action='store_true',
+                               help='Skip reading back copied files for verification')
+    parser_upload.add_argument('-w', '--workers', type=int, default=1,
+                               help='Number of concurrent copies per destination (main memory, card)')
+    parser_upload.add_argument('-m', '--mainpath', required=True, help='Path to mounted Pocketbook e-reader root')
+    parser_upload.add_argument('-c', '--cardpath', required=False,
+                               help='Optional path to a mounted SD card of a Pocketbook reader, for copying .acsm files')
+    parser_upload.add_argument('-i', '--files', dest='files', required=True, nargs='*',
+                               help='One or more .acsm/.ttf/.otf/.app/.dict/.pbi files')
+
+    parser_backup = subparsers.add_parser('backup', parents=[common],
+                                          help='Snapshots the explorer and books.db databases into a backup store')
+    parser_backup.add_argument('-m', '--mainpath', required=True, help='Path to mounted Pocketbook e-reader root')
+    parser_backup.add_argument('-c', '--cardpath', required=False, help='Optional path to a mounted SD card')
+    parser_backup.add_argument('-s', '--store', required=True, help='Backup store directory')
+    parser_backup.add_argument('-f', '--force', action='store_true', help='Also back up unchanged databases')
+    parser_backup.add_argument('--hash', action='store_true',
+                               help='Include a full-file digest when checking for unchanged databases')
+
+    parser_export = subparsers.add_parser('export', parents=[common], help='Exports highlights from a books.db')
+    export_source = parser_export.add_mutually_exclusive_group(required=True)
+    export_source.add_argument('-d', '--db', help='Path to a books.db')
+    export_source.add_argument('-m', '--mainpath',
+                               help='Path to mounted Pocketbook e-reader root, exports all profiles to one file')
+    export_source.add_argument('--mirror', action='store_true',
+                               help='Exports all profiles to one file from the last synced local mirror')
+    parser_export.add_argument('-c', '--cardpath', help='Optional path to a mounted SD card, with --mainpath')
+    parser_export.add_argument('-o', '--output', required=True, help='Output file')
+    parser_export.add_argument('-f', '--format', choices=sorted(HIGHLIGHT_FORMATS), default='html',
+                               help='Output format (default: html)')
+    parser_export.add_argument('--sorttitle', action='store_true', help='Sort on title and page, instead of date')
+    parser_export.add_argument('--decoder', choices=('auto', 'json1', 'python'), default='auto',
+                               help='Decode highlights in SQL (json1) or in Python (default: auto)')
+    parser_export.add_argument('--workingcopy', action='store_true',
+                               help='Query a local copy of the database with helper indexes')
+    parser_export.add_argument('--incremental', action='store_true',
+                               help='Only append highlights added since the last export to the output file')
+
+    parser_mirror = subparsers.add_parser('mirror', parents=[common],
+                                          help='Syncs a local mirror of the annotations of all profiles')
+    parser_mirror.add_argument('-m', '--mainpath', required=True, help='Path to mounted Pocketbook e-reader root')
+    parser_mirror.add_argument('-c', '--cardpath', help='Optional path to a mounted SD card')
+    parser_mirror.add_argument('--full', action='store_true', help='Copy all rows, instead of new or changed rows')
+
+    parser_stats = subparsers.add_parser('stats', parents=[common],
+                                         help='Shows annotation counts and duplicate titles of all profiles')
+    stats_source = parser_stats.add_mutually_exclusive_group(required=True)
+    stats_source.add_argument('-m', '--mainpath', help='Path to mounted Pocketbook e-reader root')
+    stats_source.add_argument('--mirror', action='store_true', help='Use the last synced local mirror')
+    parser_stats.add_argument('-c', '--cardpath', help='Optional path to a mounted SD card')
+    parser_stats.add_argument('--duplicates', action='store_true', help='List duplicate titles')
+
+    parser_search = subparsers.add_parser('search', parents=[common],
+                                          help='Searches highlight text, titles and authors of all profiles')
+    parser_search.add_argument('query', help='Words to search for (all must match)')
+    search_source = parser_search.add_mutually_exclusive_group()
+    search_source.add_argument('-m', '--mainpath', help='Update the index from a mounted Pocketbook e-reader first')
+    search_source.add_argument('--mirror', action='store_true', help='Update the index from the last synced mirror first')
+    parser_search.add_argument('-c', '--cardpath', help='Optional path to a mounted SD card, with --mainpath')
+    parser_search.add_argument('-p', '--profile', help='Only search highlights of this profile')
+    parser_search.add_argument('-n', '--limit', type=int, default=SEARCH_LIMIT, help='Maximum number of results')
+
+    parser_mergefix = subparsers.add_parser('mergefix', parents=[common],
+                                            help='Merges annotations of duplicate book entries in a books.db')
+    parser_mergefix.add_argument('-d', '--db', required=True, help='Path to a books.db')
+    parser_mergefix.add_argument('-n', '--dryrun', action='store_true', help='Only show the planned changes')
+    parser_mergefix.add_argument('--workingcopy', action='store_true',
+                                 help='Plan changes on a local copy of the database with helper indexes')
+
+    parser_snapshots = subparsers.add_parser('snapshots', parents=[common], help='Lists snapshots in a backup store')
+    parser_snapshots.add_argument('-s', '--store', required=True, help='Backup store directory')
+    parser_snapshots.add_argument('-p', '--profile', help='Only list snapshots of this profile')
+
+    parser_prune = subparsers.add_parser('prune', parents=[common],
+                                         help='Removes old snapshots and unreferenced data from a backup store')
+    parser_prune.add_argument('-s', '--store', required=True, help='Backup store directory')
+    parser_prune.add_argument('-k', '--keep', type=int, required=True, help='Snapshots to keep per profile and database (0 = all)')
+
+    parser_restore = subparsers.add_parser('restore', parents=[common], help='Restores a snapshot from a backup store')
+    parser_restore.add_argument('-s', '--store', required=True, help='Backup store directory')
+    parser_restore.add_argument('snapshot', help='Snapshot id, see snapshots')
+    parser_restore.add_argument('dest', help='Destination file')
+
+    argv = sys.argv[1:]
+    if not argv or argv[0] not in subparsers.choices and argv[0] not in ('-h', '--help'):
+        argv = ['upload'] + argv  # compatibility with the original upload-only CLI
+    args = parser.parse_args(argv)
 
     if args.debug:
         import logging
@@ -449,20 +2195,132 @@ if __name__ == "__main__":
         logger.addHandler(console)
 
         logger.debug(args)
-        for path in args.files:
+        for path in getattr(args, 'files', []):
             logger.debug('realpath: ' + os.path.realpath(path))
 
+    querytrace.enabled = args.queryplan
+    runsummary.reset(args.command)
+
+    def _cli_bookdbs(args):
+        """Returns the (profile, books.db path) pairs of a device, or of the last synced mirror."""
+        if args.mirror:
+            mirror = AnnotationMirror.last()
+            if not mirror:
+                sys.exit('! No local mirror found, see the mirror command')
+            return mirror.bookdbs()
+        explorerdbpath, profilepaths, bookdbs = discover_device(args.mainpath, getattr(args, 'cardpath', None))
+        if not explorerdbpath:
+            sys.exit('! No explorer database found at %s' % args.mainpath)
+        return bookdbs
+
     # start
-    if args.zipenabled:
-        import zipfile
-
-    fileobjs = uploader_prep(files=args.files,
-                        mainpath=args.mainpath,
-                        cardpath=args.cardpath if args.cardpath else None,
-                        zipenabled=args.zipenabled,
-                        replace=args.replace,
-                        #deletemode=prefs['up_deletemode'],
-                        gui=False)
-
-    text = uploader_copy(fileobjs, gui=False)
-    print(text[0])
+    if args.command == 'upload':
+        explorerdbpath = getexplorerdb(args.mainpath)
+        index = DeviceIndex.for_device(explorerdbpath) if explorerdbpath else None
+        journal = UploadJournal.for_device(explorerdbpath) if explorerdbpath else None
+
+        skipped = collections.Counter()
+        fileobjs = uploader_prep(files=args.files,
+                            mainpath=args.mainpath,
+                            cardpath=args.cardpath if args.cardpath else None,
+                            zipenabled=args.zipenabled,
+                            replace=args.replace,
+                            #deletemode=prefs['up_deletemode'],
+                            gui=False,
+                            index=index,
+                            skipped=skipped,
+                            journal=journal)
+        for msg, count in sorted(skipped.items()):
+            print('! %s: %d file(s)' % (msg, count))
+
+        text = uploader_copy(fileobjs, gui=False, verify=not args.trust, workers=args.workers, index=index,
+                             journal=journal)
+        print(text[0])
+
+    elif args.command == 'backup':
+        explorerdbpath, profilepaths, bookdbs = discover_device(args.mainpath, args.cardpath)
+        if not explorerdbpath:
+            sys.exit('! No explorer database found at %s' % args.mainpath)
+        store = BackupStore(args.store)
+        fingerprints = BackupFingerprints(args.store)
+        for profile, path in [('defaultroot', explorerdbpath)] + bookdbs:
+            if not os.path.exists(path):
+                continue
+            fingerprint = dbfingerprint(path, withhash=args.hash)
+            reason = fingerprints.unchanged(path, fingerprint)
+            if reason and not args.force:
+                print('%s -- skipped, %s' % (path, reason))
+                continue
+            manifest = store.snapshot(profile, path)
+            if manifest:
+                fingerprints.record(path, fingerprint, manifest['path'])
+                print('%s -- %d of %d chunks new' % (manifest['id'], manifest['newchunks'], len(manifest['chunks'])))
+            else:
+                print('! %s -- backup failed' % path)
+        fingerprints.save()
+
+    elif args.command == 'export':
+        json1 = {'auto': None, 'json1': True, 'python': False}[args.decoder]
+        if args.mainpath or args.mirror:
+            bookdbs = _cli_bookdbs(args)
+            highlightcount = export_device_highlights(bookdbs, args.output, fmt=args.format,
+                                                      sortontitle=args.sorttitle, json1=json1)
+        else:
+            highlightcount = export_highlights(args.db, args.output, fmt=args.format, sortontitle=args.sorttitle,
+                                               incremental=args.incremental, json1=json1, usecopy=args.workingcopy)
+        print('Exported %d highlights to %s' % (highlightcount, args.output))
+
+    elif args.command == 'mirror':
+        explorerdbpath, profilepaths, bookdbs = discover_device(args.mainpath, args.cardpath)
+        if not explorerdbpath:
+            sys.exit('! No explorer database found at %s' % args.mainpath)
+        mirror = AnnotationMirror.for_device(explorerdbpath)
+        for profile, path, result in mirror.sync(bookdbs, full=args.full):
+            print('%s (%s): %s' % (profile, path, 'unchanged' if result is None else
+                                   ', '.join('%d %s' % (count, table) for table, count in result.items())))
+
+    elif args.command == 'stats':
+        with ProfileDbs(_cli_bookdbs(args)) as dbs:
+            for profile, path, stats in dbs.stats():
+                print('%s (%s): %d highlights, %d bookmarks, %d duplicate titles' % (
+                    profile, path, stats['highlights'], stats['bookmarks'], stats['titledupes']))
+            if args.duplicates:
+                for profile, path, title, authors, entries in dbs.duplicates():
+                    print('%s: %s - %s (%d entries)' % (profile, title, authors, entries))
+
+    elif args.command == 'search':
+        index = HighlightIndex()
+        try:
+            if args.mirror or args.mainpath:
+                bookdbs = _cli_bookdbs(args)
+                device = AnnotationMirror.last().devicekey if args.mirror else devicekey(getexplorerdb(args.mainpath))
+                index.update(bookdbs, device)
+            for result in search(args.query, profile=args.profile, limit=args.limit, index=index):
+                print('%s - %s (p. %s, %s)\n    %s\n' % (result.title, result.authors, result.page, result.profile,
+                                                       result.snippet.replace('\n', ' ')))
+        finally:
+            index.close()
+
+    elif args.command == 'mergefix':
+        plan, changedrows = mergefix_annotations(args.db, dryrun=args.dryrun, usecopy=args.workingcopy)
+        print(mergefix_report(plan, dryrun=args.dryrun))
+
+    elif args.command == 'snapshots':
+        for manifest in BackupStore(args.store).snapshots(profile=args.profile):
+            print('%s  %s  %d bytes' % (manifest['id'].ljust(50), manifest['created'], manifest['size']))
+
+    elif args.command == 'prune':
+        removed, removedchunks = BackupStore(args.store).prune(args.keep)
+        print('Removed %d snapshot(s) and %d chunk(s)' % (len(removed), removedchunks))
+
+    elif args.command == 'restore':
+        if not BackupStore(args.store).restore(args.snapshot, args.dest):
+            sys.exit('! Restore failed')
+        print('Restored %s to %s' % (args.snapshot, args.dest))
+
+    if args.queryplan:
+        print(querytrace.report())
+
+    summary = runsummary.emit()
+    if args.summary:
+        print(json.dumps(summary, indent=1))
@@ -0,0 +1,51 @@
+"""Checks that highlight exports decoded in SQL (JSON1) and in Python are byte-identical."""
+import os, sys, shutil, sqlite3, tempfile, unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmark'))
+
+import main
+import gendb
+
+
+def _hasjson1():
+    con = sqlite3.connect(':memory:')
+    try:
+        return main.hasjson1(con)
+    finally:
+        con.close()
+
+
+@unittest.skipUnless(_hasjson1(), 'sqlite without JSON1')
+class DecoderParityTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = tempfile.mkdtemp(prefix='pbt-test-')
+        cls.db = os.path.join(cls.workdir, 'books.db')
+        # includes notes, bookmarks, deleted items, Notes app edits and escaping-sensitive text
+        gendb.build_booksdb(cls.db, highlights=2000, seed=1)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.workdir)
+
+    def _export(self, fmt, sortontitle, json1):
+        path = os.path.join(self.workdir, 'export-%s-%s-%s' % (fmt, sortontitle, json1))
+        count = main.export_highlights(self.db, path, fmt=fmt, sortontitle=sortontitle, json1=json1)
+        with open(path, 'rb') as fin:
+            return count, fin.read()
+
+    def test_formats(self):
+        for fmt in main.HIGHLIGHT_FORMATS:
+            for sortontitle in (False, True):
+                with self.subTest(fmt=fmt, sortontitle=sortontitle):
+                    sqlcount, sqlexport = self._export(fmt, sortontitle, True)
+                    pycount, pyexport = self._export(fmt, sortontitle, False)
+                    self.assertGreater(sqlcount, 0)
+                    self.assertEqual(sqlcount, pycount)
+                    self.assertEqual(sqlexport, pyexport)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,7 +5,7 @@ from calibre.gui2 import info_dialog, error_dialog, question_dialog, open_url
 
 try:
     from PyQt5.Qt import (Qt, QApplication, pyqtSignal, QIcon, QMenu, QAction, QRegularExpression, QUrl,
-                          QColor, QHBoxLayout, QTableWidget, QTableWidgetItem)
+                          QProgressDialog, QInputDialog)
 except ImportError as e:
     print('Problem loading QT5: ', e)
 
@@ -19,14 +19,15 @@ except ImportError:
 
 from calibre.gui2.dialogs.message_box import MessageBox
 
-import os, sqlite3, zipfile
+import os, threading, html, collections
 from calibre_plugins.pocketbook_tools.config import prefs
 from calibre.utils.config import config_dir
 from calibre_plugins.pocketbook_tools.main import \
-    getexplorerdb, sqlite_execute_query, profilepath, getprofilepaths, \
-    uploader_prep, uploader_copy, export_htmlhighlights, dbbackup, \
-    copyfile, mergefix_annotations
-from calibre_plugins.pocketbook_tools.ui_dialogs import uploaderTW
+    uploader_prep, uploader_copy, export_highlights, export_device_highlights, HIGHLIGHT_FORMATS, dbbackup, \
+    mergefix_annotations, mergefix_report, ProfileDbs, AnnotationMirror, HighlightIndex, search, \
+    DeviceIndex, UploadJournal, devicekey, DbPool, DiscoveryCache, BackupStore, BackupFingerprints, dbfingerprint, \
+    querytrace, runsummary
+from calibre_plugins.pocketbook_tools.ui_dialogs import uploaderTW, uploaderModel
 
 # logging
 import logging, logging.config
@@ -34,6 +35,7 @@ import logging, logging.config
 # logging.config.fileConfig(load_resources('logging.conf'))
 logger = logging.getLogger('pbt_logger')
 logger.setLevel(logging.DEBUG if prefs['debug'] else logging.INFO)
+querytrace.enabled = prefs['debug']
 console = logging.StreamHandler()
 console.setFormatter(
     logging.Formatter('%(asctime)s: %(levelname)s - %(filename)s:%(lineno)d:%(funcName)s - %(message)s'))  # %(relativeCreated)d
@@ -56,6 +58,8 @@ class PocketBookToolsPlugin(InterfaceAction):
     popup_type = 2  # QToolButton.InstantPopup
 
     plugin_device_connection_changed = pyqtSignal(object)
+    plugin_device_discovered = pyqtSignal(object)
+    plugin_mirror_synced = pyqtSignal(object)
 
     def genesis(self):
         # This method is called once per plugin, do initial setup here
@@ -68,6 +72,13 @@ class PocketBookToolsPlugin(InterfaceAction):
         self.mainpath = None
         self.cardpath = None
         self.explorerdbpath = None
+        self.dbpool = DbPool()
+        self.discoverycache = DiscoveryCache()
+        self.discoverygeneration = 0
+        self.plugin_device_discovered.connect(self.on_device_discovered)
+        self.mirror = AnnotationMirror.last() if prefs['gn_mirror'] else None
+        self.mirrorsynced = False
+        self.plugin_mirror_synced.connect(self.on_mirror_synced)
         device_signals.device_connection_changed.connect(self.on_device_connection_changed)
 
         # add menu
@@ -81,6 +92,8 @@ class PocketBookToolsPlugin(InterfaceAction):
     def on_device_connection_changed(self, is_connected):
         # starts disconnected
         self.plugin_device_connection_changed.emit(is_connected)
+        self.discoverygeneration += 1
+        self.mirrorsynced = False
         if is_connected:
             self.connected_device = self.gui.device_manager.device
             VID = getattr(self.connected_device, 'VENDOR_ID', 0)
@@ -91,19 +104,20 @@ class PocketBookToolsPlugin(InterfaceAction):
                 self.mainpath = getattr(self.connected_device, '_main_prefix', None)
                 self.cardpath = self.connected_device.card_prefix()[0]
 
-                self.explorerdbpath = getexplorerdb(self.mainpath)
-                if not self.explorerdbpath:
-                    logger.critical('Nothing found at explorerdb path. Blocking device functions.')
-                    return
-                self.profiles = sqlite_execute_query(self.explorerdbpath,
-                                                     query="SELECT name from profiles")  # tested v37
-                self.profilepaths = getprofilepaths(self.profiles, self.mainpath, self.cardpath)
-                # alt: search for books.db. However, if count > 1 complexity becomes similar.
-                self.bookdbs = [(profile, os.path.join(path, 'books.db')) for profile, path in self.profilepaths]
-
-                self.menu_toggle_deviceactions(True)
-                logger.debug('Explorerpath: %s' % self.explorerdbpath)
-                logger.debug('Bookdb info: %s' % self.bookdbs)
+                # discovery probes the (possibly slow) device, so run it off the GUI thread
+                generation = self.discoverygeneration
+                deviceid = getattr(self.connected_device, 'name', 'Unknown')
+                mainpath, cardpath = self.mainpath, self.cardpath
+
+                def discover():
+                    try:
+                        result = self.discoverycache.discover(deviceid, mainpath, cardpath)
+                    except:
+                        logger.exception('Device discovery failed')
+                        result = (None, [], [])
+                    self.plugin_device_discovered.emit((generation,) + result)
+
+                threading.Thread(target=discover, name='pbt_discovery', daemon=True).start()
         else:
             logger.debug('No PocketBook connected')
             self.menu_toggle_deviceactions(False)
@@ -112,11 +126,69 @@ class PocketBookToolsPlugin(InterfaceAction):
             self.mainpath = None
             self.cardpath = None
             self.explorerdbpath = None
+            self.dbpool.close()
+
+    def on_device_discovered(self, result):
+        generation, explorerdbpath, profilepaths, bookdbs = result
+        if generation != self.discoverygeneration:
+            logger.debug('Ignoring outdated discovery result')
+            return
+        if not explorerdbpath:
+            logger.critical('Nothing found at explorerdb path. Blocking device functions.')
+            return
+
+        self.explorerdbpath = explorerdbpath
+        self.profilepaths = profilepaths
+        self.bookdbs = bookdbs
+        self.menu_toggle_deviceactions(True)
+        logger.debug('Explorerpath: %s' % self.explorerdbpath)
+        logger.debug('Bookdb info: %s' % self.bookdbs)
+        if prefs['gn_mirror']:
+            self.syncmirror(self.bookdbs)
+
+    def syncmirror(self, bookdbs, full=False):
+        """Syncs the local annotation mirror in a background thread."""
+        generation = self.discoverygeneration
+        mirror = AnnotationMirror.for_device(self.explorerdbpath)
+
+        def sync():
+            try:
+                mirror.sync(bookdbs, full=full)
+            except:
+                logger.exception('Syncing annotation mirror failed')
+                return
+            self.plugin_mirror_synced.emit((generation, mirror))
+
+        threading.Thread(target=sync, name='pbt_mirror', daemon=True).start()
+
+    def on_mirror_synced(self, result):
+        generation, mirror = result
+        if generation != self.discoverygeneration:
+            return
+        self.mirror = mirror
+        self.mirrorsynced = True
+        logger.debug('Annotation mirror synced: %s' % mirror.root)
+
+    def annotationdbs(self):
+        """Returns the (profile, books.db path) pairs to read annotations from: the local mirror if
+        synced or while disconnected, otherwise the device's."""
+        if self.mirror and (self.explorerdbpath is None or self.mirrorsynced):
+            return self.mirror.bookdbs()
+        return self.bookdbs
+
+    def annotationdevice(self):
+        """Returns the devicekey of the annotationdbs."""
+        if self.explorerdbpath:
+            return devicekey(self.explorerdbpath)
+        return self.mirror.devicekey if self.mirror else None
 
     def menu_toggle_deviceactions(self, present=False):
         actions = self.menu.findChildren(QAction, QRegularExpression('pb_.*'))
         for action in actions:
             action.setEnabled(present)
+        if not present and self.mirror and self.mirror.bookdbs():
+            self.pbexporthighlights.setEnabled(True)  # from the local mirror
+            self.pbsearchhighlights.setEnabled(True)
 
         if present:
             self.deviceinfo.setText(_('Found PocketBook. Driver: %s' % self.connected_device.name or 'Unknown'))
@@ -156,12 +228,20 @@ class PocketBookToolsPlugin(InterfaceAction):
 
         self.pbexporthighlights = self.create_menu_action(m,
                                                           unique_name='pb_exporthighlights',
-                                                          text=_('Export highlights to HTML') + '…',
+                                                          text=_('Export highlights') + '…',
                                                           icon=QIcon(I('save.png')),
                                                           triggered=self.show_exporthighlights,
                                                           )
         self.pbexporthighlights.setObjectName('pb_exporthighlights')
 
+        self.pbsearchhighlights = self.create_menu_action(m,
+                                                          unique_name='pb_searchhighlights',
+                                                          text=_('Search highlights') + '…',
+                                                          icon=QIcon(I('search.png')),
+                                                          triggered=self.show_searchhighlights,
+                                                          )
+        self.pbsearchhighlights.setObjectName('pb_searchhighlights')
+
         self.pbmergefix_annotations = self.create_menu_action(m,
                                                               unique_name='pb_merge_anns',
                                                               text=_('Merge/fix annotations on device') + '…',
@@ -236,140 +316,55 @@ class PocketBookToolsPlugin(InterfaceAction):
         if not files:
             return
 
+        runsummary.reset('upload')
+        querytrace.reset()
         # COPY
+        index = DeviceIndex.for_device(self.explorerdbpath)
+        journal = UploadJournal.for_device(self.explorerdbpath)
+        skipped = collections.Counter()
         fileobjs = uploader_prep(files,
                             mainpath=self.mainpath,
                             cardpath=self.cardpath if prefs['up_acsmtocard'] else None,
                             zipenabled=zipenabled,
                             replace=prefs['up_alwaysreplace'],
                             deletemode=prefs['up_deletemode'],
-                            gui=True)
-
-        t = uploaderTW()
-
-        rows = len(fileobjs)
-        if (rows > 0):
-            t.tableWidget.setRowCount(rows)
-
-        # add objs
-        for row, fileobj in enumerate(fileobjs):
-            cb_copy = QTableWidgetItem(fileobj.filename)
-            cb_card = QTableWidgetItem()
-            cb_delete = QTableWidgetItem("ZIP" if fileobj.archive_parent else None)
-            filetype = QTableWidgetItem(fileobj.filetype or '')
-            msg = QTableWidgetItem(fileobj.msg or '')
-
-            # checker.setProperty("fileobj", row)
-            cb_copy.setData(100, row)
-            cb_copy.setData(102, fileobj.filename)
-            cb_card.setData(100, row)
-            cb_delete.setData(100, row)
-            cb_delete.setData(101, fileobj.archive_parent)
-
-            if fileobj.filetype:
-                cb_copy.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled | Qt.ItemIsEditable)
-            else:
-                cb_copy.setFlags(Qt.ItemIsUserCheckable)
-
-            if fileobj.process:
-                cb_delete.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled)
-            else:
-                cb_delete.setFlags(Qt.ItemIsUserCheckable)
-
-            if self.cardpath and fileobj.filetype == "ACSM":
-                cb_card.setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled)
-            else:
-                cb_card.setFlags(Qt.ItemIsUserCheckable)
-
-            filetype.setFlags(Qt.ItemIsEnabled)
-            msg.setFlags(Qt.ItemIsEnabled)
-
-            cb_copy.setCheckState(Qt.Checked if fileobj.process else Qt.Unchecked)
-            cb_card.setCheckState(Qt.Checked if fileobj.tocard else Qt.Unchecked)
-            cb_delete.setCheckState(Qt.Checked if fileobj.process and fileobj.delete and fileobj.filetype else Qt.Unchecked)
-
-            filetype.setTextAlignment(Qt.AlignHCenter | Qt.AlignVCenter)
-            if cb_delete.checkState() == Qt.Checked:
-                cb_delete.setBackground(QColor('orange'))
-
-            t.tableWidget.setItem(row, 0, cb_copy)
-            t.tableWidget.setItem(row, 1, filetype)
-            t.tableWidget.setItem(row, 2, cb_card)
-            t.tableWidget.setItem(row, 3, msg)
-            t.tableWidget.setItem(row, 4, cb_delete)
-
-        # table settings
-        t.tableWidget.sortByColumn(1, Qt.DescendingOrder)
-        t.tableWidget.setSortingEnabled(True)
-
-        # connections
-        def get_tableitemchecked(item):
-            return True if item.checkState() == Qt.Checked else False
-
-        def cellclicked(item):
-            fileobj_nr = item.data(100)
-            row = item.row()
-            col = item.column()
-            if col == 0:
-                checked = get_tableitemchecked(item)
-                fileobjs[fileobj_nr].process = checked
-                logger.debug("Fileobj.process after: %s" % fileobjs[fileobj_nr].process)
-                if not checked:
-                    t.tableWidget.item(row, 4).setFlags(Qt.ItemIsUserCheckable)
-                else:
-                    t.tableWidget.item(row, 4).setFlags(Qt.ItemIsUserCheckable | Qt.ItemIsEnabled)
-            elif col == 2:
-                checked = get_tableitemchecked(item)
-                fileobjs[fileobj_nr].setroot(self.cardpath if checked else self.mainpath,
-                                             tocard=checked)
-                logger.debug("Fileobj.dest_full after: %s" % fileobjs[fileobj_nr].dest_full)
-            elif col == 4:
-                checked = get_tableitemchecked(item)
-                fileobjs[fileobj_nr].delete = checked
-                logger.debug('fileobj delete? %s' % fileobjs[fileobj_nr].delete)
-
-                archive_parent = item.data(101)
-                if not archive_parent:
-                    fileobjs[fileobj_nr].delete = checked
-                else:
-                    logger.debug('toggling delete for archive items of: %s' % archive_parent)
-                    # should use model/index, but works for now
-                    for nrow in range(t.tableWidget.rowCount()):
-                        item2 = t.tableWidget.item(nrow, col)
-                        if item2.data(101) == archive_parent:
-                            # t.tableWidget.item(nrow, col).setCheckState(Qt.Checked if checked else Qt.Unchecked)
-                            item2.setCheckState(Qt.Checked if checked else Qt.Unchecked)
-                            fileobjs[item2.data(100)].delete = checked
-
-        def cellchanged(item):
-            if item.data(102):
-                infocell = t.tableWidget.item(item.row(), 3)
-                if item.text() != item.data(102):
-                    # extension check...
-                    item.setBackground(Qt.yellow)
-                    infocell.setBackground(Qt.yellow)
-                    infocell.setText('Filename (was) changed (user)')
-                    fileobjs[item.data(100)].dest_filename = item.text()
-                    logger.debug('Renamed dest_full: %s' % fileobjs[item.data(100)].dest_full)
-                else:
-                    item.setBackground(Qt.white)
-                    infocell.setBackground(Qt.white)
-
-        t.tableWidget.itemClicked.connect(cellclicked)
-        t.tableWidget.itemChanged.connect(cellchanged)
-
-        temp = t.exec_()
-
-        if temp:
-            report, copycount = uploader_copy(fileobjs,
-                                gui=True)
-        else:
-            return
+                            gui=True,
+                            index=index,
+                            skipped=skipped,
+                            journal=journal)
+
+        cancel = threading.Event()
+
+        def startcopy():
+            verify = not prefs['up_trustcopy']
+
+            def upload():
+                try:
+                    report, copycount = uploader_copy(fileobjs,
+                                        gui=True,
+                                        verify=verify,
+                                        workers=prefs['up_workers'],
+                                        index=index,
+                                        progress=t.progressed.emit,
+                                        cancel=cancel,
+                                        filedone=t.filedone.emit,
+                                        journal=journal)
+                except:
+                    logger.exception('Upload failed')
+                    t.finished_upload.emit('Upload failed, see the debug log')
+                    return
+                summary = [line for line in report.splitlines() if line.startswith('Copied ')]
+                t.finished_upload.emit('%d files uploaded%s. %s' % (
+                    copycount, ' (cancelled)' if cancel.is_set() else '', summary[0] if summary else ''))
+                runsummary.emit()
 
-        d = MessageBox(MessageBox.INFO, "Upload(s) finished", '%d files uploaded (details below):' % copycount,
-                       det_msg=report, show_copy_button=True)
-        d.exec_()
+            threading.Thread(target=upload, name='pbt_upload', daemon=True).start()
 
+        t = uploaderTW(uploaderModel(fileobjs, self.mainpath, self.cardpath), startcopy=startcopy, journal=journal)
+        t.cancelrequested.connect(cancel.set)
+        if skipped:
+            t.label.setText(t.label.text() + '\n' + ', '.join('%s: %d file(s)' % item for item in sorted(skipped.items())))
+        t.exec_()
 
     def show_backup_annotations(self):
         logger.debug('Starting...')
@@ -377,100 +372,227 @@ class PocketBookToolsPlugin(InterfaceAction):
         exportdir = choose_dir(self.gui, 'backupdir', title='Choose backup directory')
         if not exportdir:
             return
+        runsummary.reset('backup')
+        querytrace.reset()
 
         copiedfiles = []
         notcopiedfiles = []
+        skippedfiles = []
+        store = BackupStore(exportdir) if prefs['bk_mode'] == 1 else None
+        fingerprints = BackupFingerprints(exportdir)
+        progressdialog = QProgressDialog('', None, 0, 100, self.gui)
+        progressdialog.setWindowTitle('Database(s) backup')
+        progressdialog.setWindowModality(Qt.WindowModal)
+        progressdialog.setMinimumDuration(0)
+
+        def backup(profile, path):
+            try:
+                fingerprint = dbfingerprint(path, withhash=prefs['bk_fingerprinthash'])
+            except OSError:  # e.g. a profile without books.db
+                logger.exception('Reading database failed: %s' % path)
+                notcopiedfiles.append(path)
+                return
+            reason = fingerprints.unchanged(path, fingerprint)
+            if reason and prefs['bk_skipunchanged']:
+                logger.debug('Skipping unchanged db: %s' % path)
+                skippedfiles.append((path, reason))
+                return
 
-        # backup explorer
-        logger.debug('Starting backup for: %s' % self.explorerdbpath)
-        copied = dbbackup('defaultroot', self.explorerdbpath, exportdir, labeltime=True)
-        if copied:
-            copiedfiles += [self.explorerdbpath]
-        else:
-            notcopiedfiles += [self.explorerdbpath]
-
-        # backup books.db
-        for profile, path in self.bookdbs:
-            if not prefs['bk_include_emptybookdb'] and sqlite_execute_query(
-                    path, r"SELECT COUNT(*) FROM Tags WHERE TagID == 102")[0] < 1:
-                logger.debug('Skipping bookdb backup: %s' % path)
-                continue
             logger.debug('Starting backup for: %s' % path)
-            copied = dbbackup(profile, path, exportdir, labeltime=True)
-            if copied:
-                copiedfiles += [path]
+            progress = self._backupprogress(progressdialog, profile, path)
+            if store:
+                manifest = store.snapshot(profile, path, pages=prefs['bk_pagesperstep'], progress=progress)
+                backuppath = manifest['path'] if manifest else None
+            else:
+                backuppath = dbbackup(profile, path, exportdir, labeltime=True,
+                                      pages=prefs['bk_pagesperstep'], progress=progress)
+            if backuppath:
+                fingerprints.record(path, fingerprint, backuppath)
+                copiedfiles.append(path)
             else:
-                notcopiedfiles += [path]
+                notcopiedfiles.append(path)
+
+        # backup explorer
+        backup('defaultroot', self.explorerdbpath)
 
+        # backup books.db
+        with self.dbpool:
+            for profile, path in self.bookdbs:
+                if not prefs['bk_include_emptybookdb'] and self.dbpool.stats(path)['annotations'] < 1:
+                    logger.debug('Skipping bookdb backup: %s' % path)
+                    skippedfiles.append((path, 'no annotations'))
+                    continue
+                backup(profile, path)
+
+        fingerprints.save()
+        progressdialog.close()
         logger.debug('copied files: %s' % (copiedfiles))
         logger.debug('notcopied files: %s' % (notcopiedfiles))
         
-        text = 'Nothing exported'
+        counts = ', '.join('%d %s' % (len(files), label) for files, label in
+                           ((skippedfiles, 'skipped'), (notcopiedfiles, 'failed')) if files)
+        text = 'Nothing backed up' + (' (%s)' % counts if counts else '')
         report = ''
+        if skippedfiles:
+            for db, reason in skippedfiles:
+                report += 'Skipped: %s (%s)\n' % (db, reason)
+            report += '\n'
         if copiedfiles:
-            text = 'Exported %d database(s) to:<br />' \
-                   '<a href=\'file:%s\'>%s</a>' % (len(copiedfiles), exportdir, exportdir)
+            text = 'Backed up %d database(s)%s to:<br />' \
+                   '<a href=\'file:%s\'>%s</a>' % (len(copiedfiles), ' (%s)' % counts if counts else '',
+                                                   exportdir, exportdir)
             for db in copiedfiles:
                 report += 'Copied: %s\n' % db
             report += '\n\n' if notcopiedfiles else ''
         if notcopiedfiles:
             for db in notcopiedfiles:
                 report += 'FAILED: %s\n' % db
+        if store and prefs['bk_keepsnapshots']:
+            removed, removedchunks = store.prune(prefs['bk_keepsnapshots'])
+            report += '\nPruned %d old snapshot(s), %d unused chunk(s)\n' % (len(removed), removedchunks)
 
+        runsummary.emit()
         d = MessageBox(MessageBox.INFO, 'Database(s) backup finished',
                        text, det_msg=report,
                        show_copy_button=True)
         d.exec_()
 
+    def _backupprogress(self, progressdialog, profile, path):
+        """Returns a dbbackup progress callback, showing per-database progress."""
+        progressdialog.setLabelText('Backing up %s (%s)' % (os.path.basename(path), profile))
+        progressdialog.setValue(0)
+        QApplication.processEvents()
+
+        def progress(remaining, total):
+            progressdialog.setValue(int(100 * (total - remaining) / total) if total else 100)
+            QApplication.processEvents()
+        return progress
+
     def show_exporthighlights(self):
         logger.debug('Starting...')
+        runsummary.reset('export')
+        querytrace.reset()
 
         text = 'Exported highlights to:<br/>'
         exportedfiles = []
-        filefilters = [('HTML', ['html', 'htm'])]
-        for profile, path in self.bookdbs:
-            if sqlite_execute_query(
-                    path, r"SELECT COUNT(*) FROM Tags WHERE TagID = 102 and Val <> 'bookmark'")[0] < 1:
-                continue
+        fmt = prefs['hl_format'] if prefs['hl_format'] in HIGHLIGHT_FORMATS else 'html'
+        label, extensions = HIGHLIGHT_FORMATS[fmt][:2]
+        filefilters = [(label, list(extensions))]
+        allprofiles = prefs['hl_allprofiles']
+        if allprofiles:
+            # one pass over all profiles, using a single connection
+            with ProfileDbs(self.annotationdbs()) as dbs:
+                bookdbs = [(profile, path) for profile, path, stats in dbs.stats() if stats['highlights'] > 0]
+            exports = [('all', bookdbs)] if bookdbs else []
+        else:
+            with self.dbpool:
+                exports = [(profile, path) for profile, path in self.annotationdbs()
+                           if self.dbpool.stats(path)['highlights'] > 0]
 
+        for profile, path in exports:
             savefile = choose_save_file(window=self.gui, name='noteexportfiles',
-                                        title='Choose export file for %s books.db file' % profile,
+                                        title='Choose export file for all profiles' if allprofiles else
+                                              'Choose export file for %s books.db file' % profile,
                                         filters=filefilters,
                                         all_files=False,
                                         initial_path=None,
-                                        initial_filename='pocketbook-highlights_export-%s.html' % profile
+                                        initial_filename='pocketbook-highlights_export-%s.%s' % (profile, extensions[0])
                                         )
             if not savefile:
                 logger.debug('Cancelling export for %s' % path)
                 continue
-            elif not savefile.lower().endswith(('.html', '.htm')):
-                savefile += '.html'
+            elif not savefile.lower().endswith(tuple('.' + ext for ext in extensions)):
+                savefile += '.' + extensions[0]
 
             logger.debug('Starting export for: %s' % path)
-            highlightcount = export_htmlhighlights(path,
+            if allprofiles:
+                highlightcount = export_device_highlights(path,
+                                                          outputfile=savefile,
+                                                          fmt=fmt,
+                                                          sortontitle=prefs['hl_sortdate'])
+            else:
+                highlightcount = export_highlights(path,
                                                    outputfile=savefile,
-                                                   sortontitle=prefs['hl_sortdate']
+                                                   fmt=fmt,
+                                                   sortontitle=prefs['hl_sortdate'],
+                                                   incremental=prefs['hl_incremental'],
+                                                   usecopy=prefs['gn_workingcopy']
                                                    )
 
-            if highlightcount:
+            if prefs['hl_incremental'] and not allprofiles:
+                exportedfiles.append(savefile)
+                text += '<a href=\'file:%s\'>%s</a> (%d new highlights)<br/>' % (savefile, savefile, highlightcount)
+            elif highlightcount:
                 exportedfiles.append(savefile)
                 text += '<a href=\'file:%s\'>%s</a> (%d highlights)<br/>' % (savefile, savefile, highlightcount)
                 logger.debug('exportedfile %s has count %d' % (exportedfiles, highlightcount))
 
         if not exportedfiles:
             text = 'No annotations exported / to export'
+        runsummary.emit()
         d = MessageBox(MessageBox.INFO, 'Highlight export finished',
                        text, det_msg=None,
                        show_copy_button=False)
         d.exec_()
 
+    def show_searchhighlights(self):
+        query, ok = QInputDialog.getText(self.gui, 'Search highlights', 'Words to find in highlights, titles or authors:')
+        if not ok or not query.strip():
+            return
+        runsummary.reset('search')
+        querytrace.reset()
+        index = HighlightIndex()
+        try:
+            index.update(self.annotationdbs(), self.annotationdevice())
+            results = search(query, index=index)
+        finally:
+            index.close()
+        runsummary.emit()
+
+        if results:
+            text = '<br/>'.join('<b>%s</b> - %s (p. %s, %s)<br/>%s<br/>' % (
+                html.escape(r.title), html.escape(r.authors), r.page, html.escape(r.profile),
+                html.escape(r.snippet).replace('[', '<b>').replace(']', '</b>')) for r in results)
+        else:
+            text = 'No highlights found for: %s' % html.escape(query)
+        d = MessageBox(MessageBox.INFO, 'Highlight search', text, det_msg=None, show_copy_button=False)
+        d.exec_()
+
     def show_mergefix_annotations(self):
+        runsummary.reset('mergefix')
+        querytrace.reset()
+        # plan first (dry-run), so the user can review the changes
+        plans = []
+        report = ''
+        for profile, path in self.bookdbs:
+            stats = self.dbpool.stats(path)
+            if stats['highlights'] < 1:
+                continue
+
+            titledupes_count = stats['titledupes']
+            logger.debug('books.db has %s duplicate title' % titledupes_count)
+            if not titledupes_count:
+                report += 'Nothing found to fix for %s\n' % path
+                continue
+            plan, changedrows = mergefix_annotations(path, dryrun=True, usecopy=prefs['gn_workingcopy'])
+            if any(row.items for row in plan):
+                plans.append(path)
+            report += 'Planned changes for \'%s\':\n' % path
+            report += mergefix_report(plan, dryrun=True)
+
+        if not plans:
+            d = MessageBox(MessageBox.INFO, 'Finished merge/fix annotations',
+                           'No annotations found to merge/fix.', det_msg=report,
+                           show_copy_button=True)
+            d.exec_()
+            return
+
         text = 'This tool will modify the device\'s annotation database(s).<br /><br />' \
                '<b>Please backup the \'books.db\' database(s) first.</b><br /><br />' \
-               'Continue?'
+               'Planned changes are listed in the details. Continue?'
         d = question_dialog(None, 'Warning',
-                            text, det_msg=None,
-                            show_copy_button=False,
+                            text, det_msg=report,
+                            show_copy_button=True,
                             default_yes=False,
                             override_icon=QIcon(I('dialog_warning.png')))
         if not d:
@@ -478,28 +600,22 @@ class PocketBookToolsPlugin(InterfaceAction):
 
         report = ''
         changedrowsum = 0
-        for profile, path in self.bookdbs:
-            if sqlite_execute_query(path,
-                                        r"SELECT COUNT(*) FROM Tags WHERE TagID = 102 and Val <> 'bookmark'")[0] < 1:
-                continue
+        for path in plans:
+            report += 'Starting inspection of \'%s\':\n' % path
+            plan, changedrows = mergefix_annotations(path, usecopy=prefs['gn_workingcopy'])
+            report += mergefix_report(plan)
+            changedrowsum += changedrows
 
-            titledupes_count = sqlite_execute_query(path,
-                                                    'SELECT COUNT(*) as title_dupes FROM (SELECT OID FROM Books'
-                                                    ' GROUP BY Title, Authors HAVING COUNT(*) > 1)')[0]
-            logger.debug('books.db has %s duplicate title' % titledupes_count)
-            if not titledupes_count:
-                report += 'Nothing found to fix for %s<br />.' % db
-            else:
-                report += 'Starting inspection of \'%s\':\n\n' % path
-                output, changedrows = mergefix_annotations(path)
-                report += output
-                changedrowsum += changedrows
+        if changedrowsum and prefs['gn_mirror']:
+            # ParentID changes don't update edit times, so resync these fully
+            self.syncmirror([(profile, path) for profile, path in self.bookdbs if path in plans], full=True)
 
         if changedrowsum:
             text = '%d rows changed.<br /><br />Please check details below.' % changedrowsum
         else:
             text = 'No annotations found to merge/fix.'
 
+        runsummary.emit()
         d = MessageBox(MessageBox.INFO, 'Finished merge/fix annotations',
                        text, det_msg=report,
                        show_copy_button=True)
@@ -517,3 +633,4 @@ class PocketBookToolsPlugin(InterfaceAction):
             logger.setLevel(logging.DEBUG)
         else:
             logger.setLevel(logging.INFO)
+        querytrace.enabled = prefs['debug']
@@ -1,14 +1,190 @@
 try:
-    from PyQt5.Qt import (QDialog, QLabel, QWidget, QVBoxLayout, QTableWidget, QTableWidgetItem,
-                          QRect, QDialogButtonBox, QCheckBox, QAbstractItemView)
+    from PyQt5.Qt import (QDialog, QLabel, QWidget, QVBoxLayout, QTableView, QAbstractTableModel, QModelIndex,
+                          Qt, QColor, QRect, QDialogButtonBox, QCheckBox, QAbstractItemView, QProgressBar, pyqtSignal)
 except ImportError as e:
     print('Problem loading QT5: ', e)
-    from PyQt4.Qt import (QDialog, QLabel, QWidget, QVBoxLayout, QTableWidget, QTableWidgetItem,
-                          QRect, QDialogButtonBox, QCheckBox, QAbstractItemView)
+    from PyQt4.Qt import (QDialog, QLabel, QWidget, QVBoxLayout, QTableView, QAbstractTableModel, QModelIndex,
+                          Qt, QColor, QRect, QDialogButtonBox, QCheckBox, QAbstractItemView, QProgressBar, pyqtSignal)
+
+import collections
+
+
+# UploaderTableModel
+class uploaderModel(QAbstractTableModel):
+    """Table model backed directly by the uploader's file objects (see main.PbFileref).
+    Checking 'Copy file?', 'Card?' and 'Delete?' and editing file names update the file objects.
+    Delete is toggled for all members of a zip archive at once, using an archive_parent: rows index.
+    While locked (uploading), rows can't be edited, and Info shows the status set using setstatus."""
+    HEADERS = ('Copy file?', 'Type', 'Card?', 'Info', 'Delete?')
+    COL_COPY, COL_TYPE, COL_CARD, COL_INFO, COL_DELETE = range(5)
+
+    def __init__(self, fileobjs, mainpath, cardpath=None, parent=None):
+        QAbstractTableModel.__init__(self, parent)
+        self.fileobjs = list(fileobjs)
+        self.mainpath = mainpath
+        self.cardpath = cardpath
+        self.locked = False
+        self.status = {}  # id(fileobj): Info text while/after uploading
+        self._reindex()
+
+    def _reindex(self):
+        self.archiverows = collections.defaultdict(list)
+        self.rows = {}  # id(fileobj): row
+        for row, fileobj in enumerate(self.fileobjs):
+            self.rows[id(fileobj)] = row
+            if fileobj.archive_parent:
+                self.archiverows[fileobj.archive_parent].append(row)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.fileobjs)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def _deletechecked(self, fileobj):
+        return bool(fileobj.process and fileobj.delete and fileobj.filetype)
+
+    def _renamed(self, fileobj):
+        return fileobj.dest_filename != fileobj.filename
+
+    def flags(self, index):
+        fileobj = self.fileobjs[index.row()]
+        col = index.column()
+        if self.locked:
+            return Qt.ItemIsEnabled
+        if col == self.COL_COPY:
+            if fileobj.filetype:
+                return Qt.ItemIsUserCheckable | Qt.ItemIsEnabled | Qt.ItemIsEditable
+            return Qt.ItemIsUserCheckable
+        elif col == self.COL_CARD:
+            if self.cardpath and fileobj.filetype == 'ACSM':
+                return Qt.ItemIsUserCheckable | Qt.ItemIsEnabled
+            return Qt.ItemIsUserCheckable
+        elif col == self.COL_DELETE:
+            if fileobj.process:
+                return Qt.ItemIsUserCheckable | Qt.ItemIsEnabled
+            return Qt.ItemIsUserCheckable
+        return Qt.ItemIsEnabled
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        fileobj = self.fileobjs[index.row()]
+        col = index.column()
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if col == self.COL_COPY:
+                return fileobj.dest_filename
+            elif col == self.COL_TYPE:
+                return fileobj.filetype or ''
+            elif col == self.COL_INFO:
+                if id(fileobj) in self.status:
+                    return self.status[id(fileobj)]
+                return 'Filename (was) changed (user)' if self._renamed(fileobj) else fileobj.msg or ''
+            elif col == self.COL_DELETE:
+                return 'ZIP' if fileobj.archive_parent else None
+        elif role == Qt.CheckStateRole:
+            if col == self.COL_COPY:
+                checked = fileobj.process
+            elif col == self.COL_CARD:
+                checked = fileobj.tocard
+            elif col == self.COL_DELETE:
+                checked = self._deletechecked(fileobj)
+            else:
+                return None
+            return Qt.Checked if checked else Qt.Unchecked
+        elif role == Qt.BackgroundRole:
+            if col in (self.COL_COPY, self.COL_INFO) and self._renamed(fileobj):
+                return QColor(Qt.yellow)
+            elif col == self.COL_DELETE and self._deletechecked(fileobj):
+                return QColor('orange')
+        elif role == Qt.TextAlignmentRole and col == self.COL_TYPE:
+            return int(Qt.AlignHCenter | Qt.AlignVCenter)
+        return None
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid() or self.locked:
+            return False
+        row = index.row()
+        fileobj = self.fileobjs[row]
+        col = index.column()
+        if role == Qt.EditRole and col == self.COL_COPY:
+            if not value:
+                return False
+            fileobj.dest_filename = value
+            self._rowchanged(row, self.COL_COPY, self.COL_INFO)
+            return True
+        elif role == Qt.CheckStateRole:
+            checked = value == Qt.Checked or value == int(Qt.Checked)
+            if col == self.COL_COPY:
+                fileobj.process = checked
+                self._rowchanged(row, self.COL_COPY, self.COL_DELETE)
+            elif col == self.COL_CARD:
+                fileobj.setroot(self.cardpath if checked else self.mainpath, tocard=checked)
+                self._rowchanged(row, self.COL_CARD, self.COL_CARD)
+            elif col == self.COL_DELETE:
+                self.setdelete(row, checked)
+            else:
+                return False
+            return True
+        return False
+
+    def setstatus(self, fileobj, text):
+        """Sets the Info text of fileobj's row."""
+        self.status[id(fileobj)] = text
+        row = self.rows[id(fileobj)]
+        self._rowchanged(row, self.COL_INFO, self.COL_INFO)
+
+    def setlocked(self, locked):
+        self.locked = locked
+        self._rowchanged(0, self.COL_COPY, self.COL_DELETE, len(self.fileobjs) - 1)
+
+    def refresh(self):
+        """Updates all rows, e.g. after the file objects' outcome was set."""
+        self._rowchanged(0, self.COL_COPY, self.COL_DELETE, len(self.fileobjs) - 1)
+
+    def setdelete(self, row, checked):
+        """Sets delete for a row, or for all rows of the same zip archive."""
+        archive_parent = self.fileobjs[row].archive_parent
+        rows = self.archiverows[archive_parent] if archive_parent else [row]
+        for nrow in rows:
+            self.fileobjs[nrow].delete = checked
+        self._rowchanged(min(rows), self.COL_DELETE, self.COL_DELETE, max(rows))
+
+    def _rowchanged(self, row, firstcol, lastcol, lastrow=None):
+        self.dataChanged.emit(self.index(row, firstcol), self.index(row if lastrow is None else lastrow, lastcol))
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        keys = {
+            self.COL_COPY: lambda f: f.dest_filename.lower(),
+            self.COL_TYPE: lambda f: f.filetype or '',
+            self.COL_CARD: lambda f: bool(f.tocard),
+            self.COL_INFO: lambda f: f.msg or '',
+            self.COL_DELETE: self._deletechecked,
+        }
+        self.layoutAboutToBeChanged.emit()
+        self.fileobjs.sort(key=keys[column], reverse=order == Qt.DescendingOrder)
+        self._reindex()
+        self.layoutChanged.emit()
+
 
 # UploaderTableWidget
 class uploaderTW(QDialog):
-    def __init__(self):
+    """Upload dialog. Without startcopy, OK accepts the dialog. With startcopy, OK calls startcopy(), and the
+    dialog shows the upload's progress (see the signals) until closed. Closing while uploading emits
+    cancelrequested instead. Copies the optional journal (see main.UploadJournal) shows as completed are
+    resumed without copying, so they don't count towards the progress."""
+    # emitted from the upload thread
+    progressed = pyqtSignal(object, int)  # fileobj, bytes written
+    filedone = pyqtSignal(object, object)  # fileobj, digest (None if failed, False if cancelled)
+    finished_upload = pyqtSignal(object)  # summary text
+    cancelrequested = pyqtSignal()
+
+    def __init__(self, model, startcopy=None, journal=None):
         QDialog.__init__(self)
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
@@ -16,22 +192,84 @@ class uploaderTW(QDialog):
         self.resize(790, 400)
         self.label = QLabel("Check files to be send. Filenames can be modified.")
         self.layout.addWidget(self.label)
-        self.tableWidget = QTableWidget()
-        self.tableWidget.setObjectName(u"uploaderTW")
-        self.tableWidget.setGeometry(QRect(0, 0, 780, 200))
-        self.tableWidget.setMinimumHeight(300)
-        self.tableWidget.setMinimumWidth(300)
-        self.tableWidget.setColumnCount(5)
-        self.tableWidget.setHorizontalHeaderLabels(('Copy file?', 'Type', 'Card?', 'Info', 'Delete?')) # , 'rowid', 'archive_parent'
+        self.model = model
+        self.tableView = QTableView()
+        self.tableView.setObjectName(u"uploaderTW")
+        self.tableView.setModel(model)
+        self.tableView.setGeometry(QRect(0, 0, 780, 200))
+        self.tableView.setMinimumHeight(300)
+        self.tableView.setMinimumWidth(300)
         for col, width in enumerate((285, 90, 50, 240, 55)):
-            self.tableWidget.setColumnWidth(col, width)
-        self.tableWidget.setAlternatingRowColors(True)
-        self.tableWidget.setSelectionMode(QAbstractItemView.NoSelection)
-        # self.tableWidget.resizeRowsToContents()
-        # self.tableWidget.resizeColumnToContents(4)
-        self.layout.addWidget(self.tableWidget)
+            self.tableView.setColumnWidth(col, width)
+        self.tableView.setAlternatingRowColors(True)
+        self.tableView.setSelectionMode(QAbstractItemView.NoSelection)
+        self.tableView.verticalHeader().setDefaultSectionSize(self.tableView.fontMetrics().height() + 6)
+        self.tableView.sortByColumn(1, Qt.DescendingOrder)
+        self.tableView.setSortingEnabled(True)
+        self.layout.addWidget(self.tableView)
+
+        self.progressBar = QProgressBar()
+        self.progressBar.setRange(0, 1000)
+        self.progressBar.setVisible(False)
+        self.layout.addWidget(self.progressBar)
 
         self.buttonBox = QDialogButtonBox(QDialogButtonBox.Cancel | QDialogButtonBox.Ok)
-        self.buttonBox.accepted.connect(self.accept)
+        self.buttonBox.accepted.connect(self.start if startcopy else self.accept)
         self.buttonBox.rejected.connect(self.reject)
         self.layout.addWidget(self.buttonBox)
+
+        self.startcopy = startcopy
+        self.journal = journal
+        self.running = False
+        self.totalbytes = 0
+        self.written = 0
+        self.filebytes = {}  # id(fileobj): bytes written
+        self.progressed.connect(self.on_progressed)
+        self.filedone.connect(self.on_filedone)
+        self.finished_upload.connect(self.on_finished)
+
+    def start(self):
+        jobs = [f for f in self.model.fileobjs if f.process and f.srcpath != f.dest_full]
+        resumed = set(id(f) for f in jobs if self.journal and self.journal.completed(f))
+        self.totalbytes = sum(f.getsize() for f in jobs if id(f) not in resumed)
+        for fileobj in jobs:
+            self.model.setstatus(fileobj, 'Resuming' if id(fileobj) in resumed else 'Waiting')
+        self.model.setlocked(True)
+        self.tableView.setSortingEnabled(False)
+        self.buttonBox.button(QDialogButtonBox.Ok).setEnabled(False)
+        self.progressBar.setVisible(True)
+        self.label.setText('Uploading %d files (%.1f MB)%s...' % (
+            len(jobs) - len(resumed), self.totalbytes / 1e6,
+            ', resuming %d copied earlier' % len(resumed) if resumed else ''))
+        self.running = True
+        self.startcopy()
+
+    def on_progressed(self, fileobj, nbytes):
+        self.written += nbytes
+        done = self.filebytes[id(fileobj)] = self.filebytes.get(id(fileobj), 0) + nbytes
+        size = fileobj.getsize()
+        self.model.setstatus(fileobj, 'Copying %d%%' % (100 * done / size if size else 100))
+        if self.totalbytes:
+            self.progressBar.setValue(int(1000 * min(self.written, self.totalbytes) / self.totalbytes))
+
+    def on_filedone(self, fileobj, digest):
+        self.model.setstatus(fileobj, 'Copied' if digest else 'Cancelled' if digest is False else
+                             'Copying or extraction failed')
+
+    def on_finished(self, text):
+        self.running = False
+        self.model.status.clear()
+        for fileobj in self.model.fileobjs:
+            if fileobj.msg_outcome:
+                self.model.status[id(fileobj)] = fileobj.msg_outcome
+        self.model.refresh()
+        self.progressBar.setValue(1000)
+        self.label.setText(text)
+        self.buttonBox.setStandardButtons(QDialogButtonBox.Close)
+
+    def reject(self):
+        if self.running:
+            self.label.setText('Cancelling...')
+            self.cancelrequested.emit()
+            return
+        QDialog.reject(self)